@@ -1,7 +1,50 @@
+import os
+
 import cv2
 import numpy as np
 from typing import Tuple, Optional, Dict
 
+# Detection runs once per request on a worker thread; letting OpenCV fan out
+# its own pool per call oversubscribes the CPU under concurrent uploads and
+# can stall detectMarkers on some multi-threaded builds.
+OPENCV_NUM_THREADS = int(os.getenv("ATC_OPENCV_THREADS", "1"))
+cv2.setNumThreads(OPENCV_NUM_THREADS)
+
+# Frames larger than this (longest side, px) are downscaled before detection.
+ARUCO_MAX_DIMENSION = int(os.getenv("ATC_ARUCO_MAX_DIM", "1600"))
+
+# Aruco3 thresholds candidate contours on a further downscaled pyramid level
+# sized so the smallest expected marker is still ~ARUCO_MIN_SIDE_CANONICAL px.
+# Markers shorter than ARUCO_MIN_MARKER_RATIO of the longest image side are
+# not searched for; lower it for shots taken from far away.
+ARUCO3_ENABLED = os.getenv("ATC_ARUCO3", "1") != "0"
+ARUCO_MIN_SIDE_CANONICAL = int(os.getenv("ATC_ARUCO_MIN_SIDE_CANONICAL", "32"))
+ARUCO_MIN_MARKER_RATIO = float(os.getenv("ATC_ARUCO_MIN_MARKER_RATIO", "0.02"))
+
+# When searching around a previously seen marker, pad its bounding box by this
+# many marker sides on every edge.
+ARUCO_ROI_MARGIN = float(os.getenv("ATC_ARUCO_ROI_MARGIN", "1.0"))
+
+# OpenCV renamed helpers across versions; support both APIs. The dictionary,
+# parameters and detector are immutable, so build them once at import.
+if hasattr(cv2.aruco, "Dictionary_get"):
+    _ARUCO_DICT = cv2.aruco.Dictionary_get(cv2.aruco.DICT_4X4_50)
+else:
+    _ARUCO_DICT = cv2.aruco.getPredefinedDictionary(cv2.aruco.DICT_4X4_50)
+
+if hasattr(cv2.aruco, "DetectorParameters_create"):
+    _ARUCO_PARAMS = cv2.aruco.DetectorParameters_create()
+    _ARUCO_DETECTOR = None
+else:
+    _ARUCO_PARAMS = cv2.aruco.DetectorParameters()
+    # Aruco3 only exists on the ArucoDetector API
+    if ARUCO3_ENABLED:
+        _ARUCO_PARAMS.useAruco3Detection = True
+        _ARUCO_PARAMS.minSideLengthCanonicalImg = ARUCO_MIN_SIDE_CANONICAL
+        _ARUCO_PARAMS.minMarkerLengthRatioOriginalImg = ARUCO_MIN_MARKER_RATIO
+    _ARUCO_DETECTOR = cv2.aruco.ArucoDetector(_ARUCO_DICT, _ARUCO_PARAMS)
+
+
 def detect_aruco_marker(image_path: str, marker_length_cm: float = 10.0) -> Tuple[bool, Optional[float], Optional[Dict[str, float]]]:
     """
     Detect ArUco marker in image and compute pixel-to-cm conversion factor.
@@ -15,60 +58,112 @@ def detect_aruco_marker(image_path: str, marker_length_cm: float = 10.0) -> Tupl
         - If marker detected: (True, cm_per_px, {"width_px": float, "height_px": float, "avg_side_px": float})
         - If not detected: (False, None, None)
     """
+    # Decode straight to grayscale; detection never needs the color planes.
+    return detect_aruco_marker_from_array(cv2.imread(image_path, cv2.IMREAD_GRAYSCALE), marker_length_cm)
+
+
+def detect_aruco_marker_from_array(image: Optional[np.ndarray], marker_length_cm: float = 10.0) -> Tuple[bool, Optional[float], Optional[Dict[str, float]]]:
+    """
+    Same as detect_aruco_marker, for an already decoded BGR or grayscale image.
+    """
+    detected, cm_per_px, marker_info, _ = detect_aruco_marker_with_bbox(image, marker_length_cm)
+    return detected, cm_per_px, marker_info
+
+
+def detect_aruco_marker_with_bbox(
+    image: Optional[np.ndarray],
+    marker_length_cm: float = 10.0,
+    search_bbox: Optional[Dict[str, float]] = None,
+) -> Tuple[bool, Optional[float], Optional[Dict[str, float]], Optional[Dict[str, float]]]:
+    """
+    Like detect_aruco_marker_from_array, also returning the marker's bounding box
+    ({"x_min", "y_min", "x_max", "y_max"} in full-frame px).
+
+    If search_bbox is given (typically the box from an earlier shot), the area
+    around it is searched first and the full frame only if nothing is found there.
+    """
     try:
-        image = cv2.imread(image_path)
         if image is None:
-            return False, None, None
-
-        gray = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
-
-        # OpenCV renamed helpers across versions; support both APIs.
-        if hasattr(cv2.aruco, "Dictionary_get"):
-            aruco_dict = cv2.aruco.Dictionary_get(cv2.aruco.DICT_4X4_50)
-        else:
-            aruco_dict = cv2.aruco.getPredefinedDictionary(cv2.aruco.DICT_4X4_50)
-
-        if hasattr(cv2.aruco, "DetectorParameters_create"):
-            aruco_params = cv2.aruco.DetectorParameters_create()
-            corners, ids, rejected = cv2.aruco.detectMarkers(
-                gray,
-                aruco_dict,
-                parameters=aruco_params,
-            )
-        else:
-            aruco_params = cv2.aruco.DetectorParameters()
-            detector = cv2.aruco.ArucoDetector(aruco_dict, aruco_params)
-            corners, ids, rejected = detector.detectMarkers(gray)
-
-        if ids is not None and len(ids) > 0:
-            marker_corners = corners[0][0]
-            side_lengths = []
-
-            for i in range(4):
-                p1 = marker_corners[i]
-                p2 = marker_corners[(i + 1) % 4]
-                side_length = np.linalg.norm(p2 - p1)
-                side_lengths.append(side_length)
-
-            avg_side_length_px = np.mean(side_lengths)
-            cm_per_px = marker_length_cm / avg_side_length_px
-
-            # Calculate marker bounding box dimensions
-            x_coords = marker_corners[:, 0]
-            y_coords = marker_corners[:, 1]
-            width_px = np.max(x_coords) - np.min(x_coords)
-            height_px = np.max(y_coords) - np.min(y_coords)
-
-            marker_info = {
-                "width_px": float(width_px),
-                "height_px": float(height_px),
-                "avg_side_px": float(avg_side_length_px)
-            }
-
-            return True, cm_per_px, marker_info
-        else:
-            return False, None, None
+            return False, None, None, None
+        gray = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY) if image.ndim == 3 else image
+
+        marker_corners = None
+        if search_bbox is not None:
+            marker_corners = _detect_marker_corners_in_roi(gray, search_bbox)
+        if marker_corners is None:
+            marker_corners = _detect_marker_corners(gray)
+        if marker_corners is None:
+            return False, None, None, None
+
+        # Edge vectors between consecutive corners (wrapping back to the first)
+        diffs = marker_corners[[1, 2, 3, 0]] - marker_corners
+        side_lengths = np.sqrt((diffs * diffs).sum(axis=1))
+
+        avg_side_length_px = side_lengths.mean()
+        cm_per_px = marker_length_cm / avg_side_length_px
+
+        # Calculate marker bounding box dimensions
+        x_min, y_min = marker_corners.min(axis=0)
+        x_max, y_max = marker_corners.max(axis=0)
+
+        marker_info = {
+            "width_px": float(x_max - x_min),
+            "height_px": float(y_max - y_min),
+            "avg_side_px": float(avg_side_length_px)
+        }
+        marker_bbox = {
+            "x_min": float(x_min),
+            "y_min": float(y_min),
+            "x_max": float(x_max),
+            "y_max": float(y_max),
+        }
+
+        return True, cm_per_px, marker_info, marker_bbox
 
     except Exception as e:
         print(f"Error detecting ArUco marker: {str(e)}")
-        return False, None, None
\ No newline at end of file
+        return False, None, None, None
+
+
+def _detect_marker_corners_in_roi(gray: np.ndarray, bbox: Dict[str, float]) -> Optional[np.ndarray]:
+    """Search a window around bbox, padded by ARUCO_ROI_MARGIN marker sides."""
+    margin = ARUCO_ROI_MARGIN * max(bbox["x_max"] - bbox["x_min"], bbox["y_max"] - bbox["y_min"])
+    height, width = gray.shape[:2]
+    x0 = max(int(bbox["x_min"] - margin), 0)
+    y0 = max(int(bbox["y_min"] - margin), 0)
+    x1 = min(int(bbox["x_max"] + margin) + 1, width)
+    y1 = min(int(bbox["y_max"] + margin) + 1, height)
+    if x1 <= x0 or y1 <= y0:
+        return None
+
+    # Slicing is a view, no copy; shift corners back into full-frame coordinates
+    corners = _detect_marker_corners(gray[y0:y1, x0:x1])
+    if corners is None:
+        return None
+    return corners + np.array([x0, y0], dtype=np.float32)
+
+
+def _detect_marker_corners(gray: np.ndarray) -> Optional[np.ndarray]:
+    """Corners (4x2, input resolution) of the first marker found, or None."""
+    # Detection cost scales with pixel count; phone uploads are far larger
+    # than needed to find the marker, so search a downscaled copy.
+    scale = 1.0
+    longest_side = max(gray.shape[:2])
+    if longest_side > ARUCO_MAX_DIMENSION:
+        scale = ARUCO_MAX_DIMENSION / longest_side
+        gray = cv2.resize(gray, None, fx=scale, fy=scale, interpolation=cv2.INTER_AREA)
+
+    if _ARUCO_DETECTOR is not None:
+        corners, ids, rejected = _ARUCO_DETECTOR.detectMarkers(gray)
+    else:
+        corners, ids, rejected = cv2.aruco.detectMarkers(
+            gray,
+            _ARUCO_DICT,
+            parameters=_ARUCO_PARAMS,
+        )
+
+    if ids is None or len(ids) == 0:
+        return None
+
+    # Map corners back to original resolution before measuring
+    return np.asarray(corners[0][0], dtype=np.float32) / scale
@@ -1,6 +1,7 @@
 import os
+import time
 from typing import Optional
-from pymongo import MongoClient
+from pymongo import ASCENDING, DESCENDING, IndexModel, MongoClient
 from pymongo.database import Database
 from pymongo.collection import Collection
 
@@ -8,20 +9,44 @@ from pymongo.collection import Collection
 MONGO_URI = os.getenv("MONGO_URI", "mongodb://localhost:27017/")
 DB_NAME = os.getenv("DB_NAME", "animal_atc")
 
+# Connection pool sizing and wire compression. zlib ships with Python; add
+# "zstd"/"snappy" here once the zstandard/python-snappy packages are installed.
+MONGO_MAX_POOL_SIZE = int(os.getenv("MONGO_MAX_POOL_SIZE", "200"))
+MONGO_MIN_POOL_SIZE = int(os.getenv("MONGO_MIN_POOL_SIZE", "10"))
+MONGO_COMPRESSORS = os.getenv("MONGO_COMPRESSORS", "zlib")
+
 # Global variables for database connection
 _client: Optional[MongoClient] = None
 _database: Optional[Database] = None
+_animals_collection: Optional[Collection] = None
+_indexes_ready = False
+_indexes_retry_at = 0.0
+
+# After a failed index build (Mongo down, duplicate animalIDs, missing
+# createIndex rights) wait this long before trying again.
+MONGO_INDEX_RETRY_SECONDS = float(os.getenv("MONGO_INDEX_RETRY_SECONDS", "60"))
+
+ANIMAL_INDEXES = [
+    IndexModel([("animalID", ASCENDING)], unique=True),
+    IndexModel([("timestamp", ASCENDING)]),
+    IndexModel([("animalID", ASCENDING), ("timestamp", DESCENDING)]),
+]
 
 def get_client() -> MongoClient:
     """Get MongoDB client instance"""
     global _client
     if _client is None:
-        # Fail fast if Mongo isn't reachable to avoid request stalls
+        # Fail fast if Mongo isn't reachable to avoid request stalls, but give
+        # queries on a live connection room to finish under load.
         _client = MongoClient(
             MONGO_URI,
+            maxPoolSize=MONGO_MAX_POOL_SIZE,
+            minPoolSize=MONGO_MIN_POOL_SIZE,
             serverSelectionTimeoutMS=2000,
             connectTimeoutMS=2000,
-            socketTimeoutMS=2000,
+            socketTimeoutMS=10000,
+            retryWrites=True,
+            compressors=MONGO_COMPRESSORS,
         )
     return _client
 
@@ -34,24 +59,29 @@ def get_db() -> Database:
     return _database
 
 def get_animals_collection() -> Collection:
-    """Get animals collection with indexes"""
-    db = get_db()
-    collection = db.animals
-    
-    # Create indexes if they don't exist
+    """Get animals collection instance"""
+    global _animals_collection
+    if _animals_collection is None:
+        _animals_collection = get_db().animals
+    return _animals_collection
+
+def ensure_indexes():
+    """Create animals collection indexes; a no-op once created or while backing off after a failure"""
+    global _indexes_ready, _indexes_retry_at
+    if _indexes_ready or time.monotonic() < _indexes_retry_at:
+        return
     try:
-        collection.create_index("animalID", unique=True)
-        collection.create_index("timestamp")
-        collection.create_index([("animalID", 1), ("timestamp", -1)])
-    except Exception as e:
-        # Indexes might already exist, ignore error
-        pass
-    
-    return collection
+        get_animals_collection().create_indexes(ANIMAL_INDEXES)
+    except Exception:
+        _indexes_retry_at = time.monotonic() + MONGO_INDEX_RETRY_SECONDS
+        raise
+    _indexes_ready = True
 
 def close_connection():
     """Close MongoDB connection"""
-    global _client
+    global _client, _database, _animals_collection
     if _client:
         _client.close()
         _client = None
+        _database = None
+        _animals_collection = None
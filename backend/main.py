@@ -1,33 +1,56 @@
-import base64
-import json
+import asyncio
+import binascii
+from bisect import bisect_right
+import io
 import os
+import threading
 import uuid
 from datetime import datetime
-from typing import Dict, Any, List, Optional
-
-from fastapi import FastAPI, HTTPException
-
-from backend.db import get_animals_collection
+from typing import Dict, Any, List, Literal, Optional, Set, Tuple
+
+import cv2
+import numpy as np
+import orjson
+import pybase64
+from cachetools import LRUCache, TTLCache
+from fastapi import BackgroundTasks, FastAPI, File, Form, HTTPException, UploadFile
+from fastapi.responses import ORJSONResponse
+from PIL import Image
+from pymongo import ReturnDocument
+from starlette.concurrency import run_in_threadpool
+
+from backend.db import close_connection, ensure_indexes, get_animals_collection
 from backend.models import (
+    AnimalUploadMetadata,
     AnimalUploadRequest,
     AnimalUploadResponse,
     AnimalResponse,
     AnimalFinalizeRequest,
     View,
 )
-from backend.aruco_utils import detect_aruco_marker
+from backend.aruco_utils import ARUCO_MAX_DIMENSION, detect_aruco_marker_with_bbox
 from backend.pose_utils import (
     KEYPOINT_NAMES,
+    KEYPOINT_NAMES_TUPLE,
     Keypoint as PoseKeypoint,
     compute_measurements,
-    detect_cattle_pose,
-    draw_debug_image,
+    detect_cattle_pose_batch,
+    detect_cattle_pose_from_array,
+    draw_debug_image_from_array,
+    get_pose_detector,
+    scale_keypoints,
+    keypoints_confidence_array,
 )
 
-app = FastAPI(title="Animal ATC API", version="1.0.0")
+app = FastAPI(title="Animal ATC API", version="1.0.0", default_response_class=ORJSONResponse)
+
+# Relative to the working directory; paths under it are built with f-strings
+# so stored paths stay relative without os.path.relpath.
+UPLOAD_ROOT = "uploads"
+DEBUG_DIR = f"{UPLOAD_ROOT}/debug"
 
-# Create uploads directory if it doesn't exist
-os.makedirs("uploads", exist_ok=True)
+# Create uploads and debug directories if they don't exist
+os.makedirs(DEBUG_DIR, exist_ok=True)
 
 TRAIT_WEIGHTS = {
     "height": 0.30,
@@ -35,35 +58,87 @@ TRAIT_WEIGHTS = {
     "rump": 0.20,
     "rear_leg": 0.20,
 }
+_TRAIT_KEYS = tuple(TRAIT_WEIGHTS)
+_TRAIT_WEIGHTS_ARR = tuple(TRAIT_WEIGHTS[key] for key in _TRAIT_KEYS)
+
+# Minimum score for each verdict, best first; anything lower is "Poor".
+VERDICT_THRESHOLDS = (
+    (9.0, "EX"),
+    (8.0, "VG"),
+    (7.0, "GP"),
+    (6.0, "G"),
+)
+# Ascending cut-offs and the verdict for each bucket between them, for bisect.
+_VERDICT_CUTS = tuple(threshold for threshold, _ in reversed(VERDICT_THRESHOLDS))
+_VERDICTS = ("Poor",) + tuple(verdict for _, verdict in reversed(VERDICT_THRESHOLDS))
 
 FALLBACK_RECORD_FILENAME = "record.json"
 
+# Recently read animal records, keyed by animalID. Entries are dropped on every
+# write; the TTL bounds staleness if another worker process updates a record.
+ANIMAL_CACHE_TTL_SECONDS = float(os.getenv("ATC_ANIMAL_CACHE_TTL", "30"))
+_animal_cache: TTLCache = TTLCache(maxsize=1024, ttl=ANIMAL_CACHE_TTL_SECONDS)
+_animal_cache_lock = threading.Lock()
+# Bumped on every invalidation, so a read that raced a write can tell its
+# document is stale and skip caching it. One small int per animal written.
+_animal_cache_generations: Dict[str, int] = {}
+
+
+def _invalidate_cached_animal(animal_id: str) -> None:
+    with _animal_cache_lock:
+        _animal_cache.pop(animal_id, None)
+        _animal_cache_generations[animal_id] = _animal_cache_generations.get(animal_id, 0) + 1
+
+
+# Repeat shots of an animal tend to frame the marker in the same place, so
+# detection can search around where it was last found before the full frame.
+# Off by default; the last box is only remembered by this worker process.
+ARUCO_ROI_ENABLED = os.getenv("ATC_ARUCO_ROI", "0") == "1"
+_marker_bbox_cache: LRUCache = LRUCache(maxsize=1024)
+_marker_bbox_lock = threading.Lock()
+
+
+# Directories already created by this process; skips a makedirs stat per upload.
+_created_dirs: Set[str] = {UPLOAD_ROOT, DEBUG_DIR}
+_created_dirs_lock = threading.Lock()
+
+
+def _ensure_dir(path: str) -> None:
+    if path in _created_dirs:
+        return
+    with _created_dirs_lock:
+        if path not in _created_dirs:
+            os.makedirs(path, exist_ok=True)
+            _created_dirs.add(path)
+
+
+def _animal_dir(animal_id: str) -> str:
+    return f"{UPLOAD_ROOT}/{animal_id}"
+
 
 def _record_file_path(animal_id: str) -> str:
-    return os.path.join("uploads", animal_id, FALLBACK_RECORD_FILENAME)
+    return f"{_animal_dir(animal_id)}/{FALLBACK_RECORD_FILENAME}"
 
 
-def _json_default(value: Any):
-    if isinstance(value, datetime):
-        return value.isoformat()
-    raise TypeError(f"Object of type {type(value).__name__} is not JSON serializable")
+def _sanitize_view_for_file(view: Dict[str, Any]) -> Dict[str, Any]:
+    uploaded_at = view.get("uploaded_at")
+    if not isinstance(uploaded_at, datetime):
+        return view
+    view_dict = dict(view)
+    view_dict["uploaded_at"] = uploaded_at.isoformat()
+    return view_dict
 
 
 def _sanitize_record_for_file(record: Dict[str, Any]) -> Dict[str, Any]:
-    cleaned: Dict[str, Any] = {k: v for k, v in record.items() if k != "_id"}
+    cleaned = record.copy()
+    cleaned.pop("_id", None)
 
     timestamp = cleaned.get("timestamp")
     if isinstance(timestamp, datetime):
         cleaned["timestamp"] = timestamp.isoformat()
 
-    views: List[Dict[str, Any]] = []
-    for view in cleaned.get("views", []):
-        view_dict = dict(view)
-        uploaded_at = view_dict.get("uploaded_at")
-        if isinstance(uploaded_at, datetime):
-            view_dict["uploaded_at"] = uploaded_at.isoformat()
-        views.append(view_dict)
-    cleaned["views"] = views
+    # Only views that still hold a datetime need copying
+    cleaned["views"] = [_sanitize_view_for_file(view) for view in cleaned.get("views", [])]
 
     return cleaned
 
@@ -73,75 +148,113 @@ def _load_record_from_file(animal_id: str) -> Optional[Dict[str, Any]]:
     if not os.path.exists(path):
         return None
     try:
-        with open(path, "r", encoding="utf-8") as infile:
-            return json.load(infile)
+        with open(path, "rb") as infile:
+            return orjson.loads(infile.read())
     except Exception:
         return None
 
 
+def _decode_upload_base64(image_base64: str) -> bytes:
+    try:
+        return pybase64.b64decode(image_base64, validate=True)
+    except binascii.Error:
+        # Tolerate whitespace and other stray characters like the stdlib decoder.
+        return pybase64.b64decode(image_base64)
+
+
+def _write_upload_bytes(filepath: str, image_bytes: bytes) -> None:
+    with open(filepath, "wb") as f:
+        f.write(image_bytes)
+
+
+def _decode_image(image_bytes: bytes) -> Optional[np.ndarray]:
+    return cv2.imdecode(np.frombuffer(image_bytes, np.uint8), cv2.IMREAD_COLOR)
+
+
+# Very large uploads are decoded by libjpeg at 1/2, 1/4 or 1/8 scale (DCT
+# scaling), as long as the result is still at least ARUCO_MAX_DIMENSION on
+# its longest side: ArUco downsizes to that anyway and pose to 640, so both
+# detectors see the same input resolution as with a full decode. Results are
+# scaled back to original pixels.
+UPLOAD_REDUCED_DECODE = os.getenv("ATC_UPLOAD_REDUCED_DECODE", "1") != "0"
+_REDUCED_DECODE_FLAGS = (
+    (8, cv2.IMREAD_REDUCED_COLOR_8),
+    (4, cv2.IMREAD_REDUCED_COLOR_4),
+    (2, cv2.IMREAD_REDUCED_COLOR_2),
+)
+
+
+def _decode_upload(image_bytes: bytes) -> Tuple[Optional[np.ndarray], float]:
+    """Decode an upload, at reduced scale when very large; returns (image, original px per image px)."""
+    if UPLOAD_REDUCED_DECODE:
+        try:
+            # Header-only read; pixels are not decoded here
+            with Image.open(io.BytesIO(image_bytes)) as header:
+                longest_side = max(header.size)
+        except Exception:
+            longest_side = 0
+        for factor, flag in _REDUCED_DECODE_FLAGS:
+            if longest_side >= factor * ARUCO_MAX_DIMENSION:
+                image = cv2.imdecode(np.frombuffer(image_bytes, np.uint8), flag)
+                if image is None:
+                    break
+                return image, longest_side / max(image.shape[:2])
+    return _decode_image(image_bytes), 1.0
+
+
 def _write_record_to_file(record: Dict[str, Any]) -> None:
-    path = _record_file_path(record["animalID"])
-    os.makedirs(os.path.dirname(path), exist_ok=True)
+    animal_dir = _animal_dir(record["animalID"])
+    _ensure_dir(animal_dir)
+    path = f"{animal_dir}/{FALLBACK_RECORD_FILENAME}"
     sanitized = _sanitize_record_for_file(record)
-    with open(path, "w", encoding="utf-8") as outfile:
-        json.dump(sanitized, outfile, default=_json_default, ensure_ascii=True, indent=2)
+    # orjson handles datetimes and numpy scalars natively, no default hook needed
+    with open(path, "wb") as outfile:
+        outfile.write(orjson.dumps(sanitized, option=orjson.OPT_INDENT_2 | orjson.OPT_SERIALIZE_NUMPY))
 
 
 
+def _mirror_record_to_file(
+    record: Dict[str, Any], background_tasks: Optional[BackgroundTasks] = None
+) -> None:
+    """Write the file copy of a record, after the response if background tasks are given."""
+    # Callers only pass tasks when Mongo already holds the write; if the file is
+    # the sole copy the next request may need to read it straight away.
+    if background_tasks is None:
+        _write_record_to_file(record)
+    else:
+        background_tasks.add_task(_write_record_to_file, record)
+
+
 def get_verdict(score: Optional[float]) -> str:
     """Determine verdict based on score."""
     if score is None:
         return "Poor"
-    if score >= 9:
-        return "EX"
-    if score >= 8:
-        return "VG"
-    if score >= 7:
-        return "GP"
-    if score >= 6:
-        return "G"
-    return "Poor"
+    return _VERDICTS[bisect_right(_VERDICT_CUTS, score)]
 
 
 def _average_confidence(keypoints: List[PoseKeypoint]) -> float:
     """Average confidence of detected keypoints."""
-    if not keypoints:
-        return 0.0
-    confidences = [kp.confidence for kp in keypoints if kp.confidence > 0]
-    if not confidences:
+    confidences = keypoints_confidence_array(keypoints)
+    confidences = confidences[confidences > 0]
+    if confidences.size == 0:
         return 0.0
-    return round(sum(confidences) / len(confidences), 3)
+    return round(float(confidences.mean()), 3)
 
 
-def _get_side_view_measurements(views: List[Dict[str, Any]]) -> Dict[str, Any]:
-    """Get measurements only from side view."""
-    for view in views:
+def _extract_side_view(views: List[Dict[str, Any]]) -> Tuple[Dict[str, Any], Optional[float], bool]:
+    """Get (measurements, score, aruco_detected) from the most recent side view."""
+    for view in reversed(views):
         if view.get("viewType") == "side":
-            return view.get("measurements", {})
-    return {}
-
-
-def _get_side_view_score(views: List[Dict[str, Any]]) -> Optional[float]:
-    """Get score only from side view."""
-    for view in views:
-        if view.get("viewType") == "side":
-            return view.get("score")
-    return None
-
-
-def _check_side_view_aruco(views: List[Dict[str, Any]]) -> bool:
-    """Check if ArUco was detected in side view."""
-    for view in views:
-        if view.get("viewType") == "side":
-            return view.get("aruco_detected", False)
-    return False
+            return view.get("measurements", {}), view.get("score"), view.get("aruco_detected", False)
+    return {}, None, False
 
 
 def compute_final_score(trait_scores: Dict[str, Optional[float]]) -> Optional[float]:
     """Compute weighted final score from normalized trait scores."""
+    # A plain loop over parallel tuples beats building NumPy arrays for four traits.
     weighted_sum = 0.0
     total_weight = 0.0
-    for trait, weight in TRAIT_WEIGHTS.items():
+    for trait, weight in zip(_TRAIT_KEYS, _TRAIT_WEIGHTS_ARR):
         value = trait_scores.get(trait)
         if value is None:
             continue
@@ -152,106 +265,163 @@ def compute_final_score(trait_scores: Dict[str, Optional[float]]) -> Optional[fl
     return round(10.0 * weighted_sum / total_weight, 2)
 
 
-def _convert_keypoints(keypoints: List[PoseKeypoint]) -> List[Dict[str, float]]:
-    converted: List[Dict[str, float]] = []
-    for idx, kp in enumerate(keypoints):
-        name = KEYPOINT_NAMES[idx] if idx < len(KEYPOINT_NAMES) else f"keypoint_{idx}"
-        converted.append(kp.to_dict(name=name))
-    return converted
+def _convert_keypoints(keypoints: List[PoseKeypoint]) -> List[Dict[str, Any]]:
+    # The detector returns exactly one keypoint per name, in KEYPOINT_NAMES order.
+    return [
+        {"name": name, "x": kp.x, "y": kp.y, "confidence": kp.confidence}
+        for name, kp in zip(KEYPOINT_NAMES_TUPLE, keypoints)
+    ]
 
 
 def _prepare_view_dict(view: View) -> Dict[str, Any]:
-    data = view.dict()
-    data["uploaded_at"] = view.uploaded_at
-    return data
-
-
-def _save_view_to_db(animal_id: str, view: View, breed: str, weight: float) -> None:
-    collection = None
-    existing: Dict[str, Any] = {}
+    # Serialized once per upload; the same dict feeds Mongo and the record file.
+    return view.model_dump(mode="python")
 
-    try:
-        collection = get_animals_collection()
-        existing = collection.find_one({"animalID": animal_id}) or {}
-    except Exception:
-        existing = _load_record_from_file(animal_id) or {}
-        collection = None
-
-    existing_views = list(existing.get("views", []))
-    new_view_dict = _prepare_view_dict(view)
-    new_views = existing_views + [new_view_dict]
 
+def _build_rescore_stages() -> List[Dict[str, Any]]:
+    """Pipeline stages that rescore a record from its latest side view."""
+    side_score_valid = {
+        "$and": [
+            {"$ne": [{"$ifNull": ["$_side.score", None]}, None]},
+            {"$eq": ["$_side.aruco_detected", True]},
+        ]
+    }
+    verdict_branches = [
+        {"case": {"$gte": ["$score", threshold]}, "then": verdict}
+        for threshold, verdict in VERDICT_THRESHOLDS
+    ]
+    return [
+        {
+            "$set": {
+                "_side": {
+                    "$arrayElemAt": [
+                        {"$filter": {"input": "$views", "cond": {"$eq": ["$$this.viewType", "side"]}}},
+                        -1,
+                    ]
+                }
+            }
+        },
+        {
+            "$set": {
+                "score": {"$cond": [side_score_valid, "$_side.score", 0.0]},
+                "measurements": {"$ifNull": ["$_side.measurements", {"$literal": {}}]},
+            }
+        },
+        {"$set": {"verdict": {"$switch": {"branches": verdict_branches, "default": "Poor"}}}},
+        {"$unset": "_side"},
+    ]
+
+
+# Only the first stage depends on the upload, so the rest is built once.
+_RESCORE_STAGES = _build_rescore_stages()
+
+
+def _rescore_record(record: Dict[str, Any]) -> None:
+    """Python twin of _RESCORE_STAGES for records that only live in the file mirror."""
     # Only use side view for final scoring
-    side_measurements = _get_side_view_measurements(new_views)
-    side_score = _get_side_view_score(new_views)
-    side_aruco_detected = _check_side_view_aruco(new_views)
+    side_measurements, side_score, side_aruco_detected = _extract_side_view(record.get("views", []))
 
     # Set final score and verdict based only on side view
     if side_score is not None and side_aruco_detected:
-        final_score = side_score
-        final_verdict = get_verdict(final_score)
+        record["score"] = side_score
+        record["verdict"] = get_verdict(side_score)
     else:
-        final_score = 0.0
-        final_verdict = "Poor"
+        record["score"] = 0.0
+        record["verdict"] = "Poor"
+    record["measurements"] = side_measurements
+
+
+def _append_view_pipeline(view_dict: Dict[str, Any], values: Dict[str, Any]) -> List[Dict[str, Any]]:
+    """Update pipeline that appends a view and rescores from the latest side view server-side."""
+    # Client-supplied values are wrapped in $literal so strings starting with
+    # "$" can't be read as field paths.
+    append_stage = {
+        "$set": {
+            **{key: {"$literal": value} for key, value in values.items()},
+            "views": {"$concatArrays": [{"$ifNull": ["$views", []]}, {"$literal": [view_dict]}]},
+        }
+    }
+    return [append_stage, *_RESCORE_STAGES]
+
 
-    timestamp = datetime.utcnow()
+def _save_view_to_db(
+    animal_id: str,
+    view: View,
+    breed: str,
+    weight: float,
+    background_tasks: Optional[BackgroundTasks] = None,
+) -> None:
+    new_view_dict = _prepare_view_dict(view)
     update_values: Dict[str, Any] = {
         "animalID": animal_id,
         "breed": breed,
         "weight": weight,
-        "score": final_score,
-        "verdict": final_verdict,
-        "measurements": side_measurements,
-        "timestamp": timestamp,
+        "timestamp": datetime.utcnow(),
     }
 
+    # Append and rescore in one round-trip so concurrent uploads can't race
+    # between reading the views and writing the new score.
+    record_for_file: Optional[Dict[str, Any]] = None
     try:
-        if collection is not None:
-            collection.update_one(
-                {"animalID": animal_id},
-                {"$set": update_values, "$push": {"views": new_view_dict}},
-                upsert=True,
-            )
+        # Retried here in case Mongo was down at startup; the unique animalID
+        # index is what keeps concurrent upserts from creating duplicates.
+        # An index failure must not keep the view out of Mongo.
+        ensure_indexes()
+    except Exception as exc:
+        print(f"Could not ensure MongoDB indexes: {exc}")
+    try:
+        collection = get_animals_collection()
+        record_for_file = collection.find_one_and_update(
+            {"animalID": animal_id},
+            _append_view_pipeline(new_view_dict, update_values),
+            upsert=True,
+            return_document=ReturnDocument.AFTER,
+        )
     except Exception:
-        collection = None
+        record_for_file = None
 
-    record_for_file: Dict[str, Any] = dict(existing)
-    record_for_file.setdefault("animalID", animal_id)
-    record_for_file.update(update_values)
-    record_for_file["views"] = new_views
+    if record_for_file is None:
+        background_tasks = None
+        existing = _load_record_from_file(animal_id) or {}
+        record_for_file = dict(existing)
+        record_for_file.update(update_values)
+        record_for_file["views"] = list(existing.get("views", [])) + [new_view_dict]
+        _rescore_record(record_for_file)
 
-    _write_record_to_file(record_for_file)
+    _invalidate_cached_animal(animal_id)
+    _mirror_record_to_file(record_for_file, background_tasks)
 
 
 def _finalize_record(
-    animal_id: str, updates: Dict[str, Any], existing_record: Optional[Dict[str, Any]] = None
+    animal_id: str,
+    details: Dict[str, Any],
+    background_tasks: Optional[BackgroundTasks] = None,
 ) -> Dict[str, Any]:
+    # Set the details and rescore in one round-trip, so a side view uploaded
+    # while finalizing still counts towards the returned score.
     record: Optional[Dict[str, Any]] = None
-
     try:
         collection = get_animals_collection()
-        base_record: Optional[Dict[str, Any]]
-        if existing_record is not None and "_id" in existing_record:
-            base_record = existing_record
-        else:
-            base_record = collection.find_one({"animalID": animal_id})
-
-        if base_record is not None:
-            collection.update_one({"animalID": animal_id}, {"$set": updates})
-            record = dict(base_record)
-            record.update(updates)
+        record = collection.find_one_and_update(
+            {"animalID": animal_id},
+            [{"$set": {key: {"$literal": value} for key, value in details.items()}}, *_RESCORE_STAGES],
+            return_document=ReturnDocument.AFTER,
+        )
     except Exception:
         record = None
 
     if record is None:
-        fallback_record = existing_record or _load_record_from_file(animal_id)
+        background_tasks = None
+        fallback_record = _load_record_from_file(animal_id)
         if not fallback_record:
             raise HTTPException(status_code=404, detail="Animal not found")
         record = dict(fallback_record)
-        record.update(updates)
+        record.update(details)
+        _rescore_record(record)
 
     record.setdefault("animalID", animal_id)
-    _write_record_to_file(record)
+    _invalidate_cached_animal(animal_id)
+    _mirror_record_to_file(record, background_tasks)
 
     if "_id" in record:
         record["_id"] = str(record["_id"])
@@ -259,140 +429,174 @@ def _finalize_record(
     return record
 
 
-@app.post("/upload", response_model=AnimalUploadResponse)
-async def upload_animal_data(data: AnimalUploadRequest):
-    """Upload animal data with view type and persist inference results."""
+@app.on_event("startup")
+def _create_indexes() -> None:
+    # Mongo may be down at boot; requests fall back to record files until it's back.
     try:
-        image_data = base64.b64decode(data.imageBase64)
-
-        animal_dir = os.path.join("uploads", data.animalID)
-        os.makedirs(animal_dir, exist_ok=True)
-
-        filename = f"{data.viewType}_{uuid.uuid4()}.jpg"
-        filepath = os.path.join(animal_dir, filename)
-        with open(filepath, "wb") as f:
-            f.write(image_data)
-
-        # Detect ArUco marker and get size information
-        detected, cm_per_px, marker_info = detect_aruco_marker(filepath)
-        
-        # Only process measurements and scoring for side view
-        if data.viewType == "side":
-            pose_success, keypoints = detect_cattle_pose(filepath)
-            
-            if not detected:
-                # ArUco not detected in side view - return error
-                view = View(
-                    viewType=data.viewType,
-                    filename=filename,
-                    uploaded_at=datetime.utcnow(),
-                    confidence=0.0,
-                    cm_per_px=None,
-                    keypoints=[],
-                    measurements={},
-                    trait_scores={},
-                    score=None,
-                    verdict="Poor",
-                    debug_image_path=None,
-                    aruco_detected=False,
-                    marker_size_px=marker_info,
-                )
-                
-                _save_view_to_db(data.animalID, view, data.breed, data.weight)
-                
-                return AnimalUploadResponse(
-                    id=data.animalID,
-                    status="saved",
-                    viewType=data.viewType,
-                    filename=filename,
-                    confidence=0.0,
-                    aruco_detected=False,
-                    cm_per_px=None,
-                    keypoints=[],
-                    measurements={},
-                    trait_scores={},
-                    final_score=None,
-                    score=None,
-                    verdict="Poor",
-                    debug_image_path=None,
-                    marker_size_px=marker_info,
-                    error_message="ArUco not detected – measurements unavailable",
-                )
-            
-            # ArUco detected - proceed with measurements
-            measurements, trait_scores = compute_measurements(keypoints, cm_per_px)
-            final_score = compute_final_score(trait_scores)
-            verdict = get_verdict(final_score)
-            confidence = _average_confidence(keypoints)
-
-            debug_dir = os.path.join("uploads", "debug")
-            os.makedirs(debug_dir, exist_ok=True)
-            debug_filename = f"{data.animalID}_{data.viewType}.png"
-            debug_full_path = os.path.join(debug_dir, debug_filename)
-            debug_image_saved = draw_debug_image(filepath, keypoints, debug_full_path, KEYPOINT_NAMES)
-            debug_image_path = (
-                os.path.relpath(debug_image_saved)
-                if debug_image_saved and os.path.exists(debug_image_saved)
-                else None
-            )
-
-            keypoint_payload = _convert_keypoints(keypoints)
-
-            view = View(
-                viewType=data.viewType,
-                filename=filename,
-                uploaded_at=datetime.utcnow(),
-                confidence=confidence,
-                cm_per_px=cm_per_px,
-                keypoints=keypoint_payload,
-                measurements=measurements,
-                trait_scores=trait_scores,
-                score=final_score,
-                verdict=verdict,
-                debug_image_path=debug_image_path,
-                aruco_detected=True,
-                marker_size_px=marker_info,
-            )
-
-            _save_view_to_db(data.animalID, view, data.breed, data.weight)
-
-            return AnimalUploadResponse(
-                id=data.animalID,
-                status="saved",
-                viewType=data.viewType,
-                filename=filename,
-                confidence=confidence,
-                aruco_detected=True,
-                cm_per_px=cm_per_px,
-                keypoints=keypoint_payload,
-                measurements=measurements,
-                trait_scores=trait_scores,
-                final_score=final_score,
-                score=final_score,
-                verdict=verdict,
-                debug_image_path=debug_image_path,
-                marker_size_px=marker_info,
-            )
-        
-        else:
-            # Front or rear view - no measurements, just store with ArUco info
+        ensure_indexes()
+    except Exception as exc:
+        print(f"Could not ensure MongoDB indexes: {exc}")
+
+
+@app.on_event("startup")
+def _load_pose_model() -> None:
+    # Load and warm up the model before serving instead of on the first upload.
+    get_pose_detector()
+
+
+@app.on_event("shutdown")
+def _close_mongo() -> None:
+    close_connection()
+
+
+def _new_upload_path(animal_id: str, view_type: str) -> Tuple[str, str]:
+    """Pick a fresh filename for an uploaded view and return (filename, filepath)."""
+    animal_dir = _animal_dir(animal_id)
+    _ensure_dir(animal_dir)
+    filename = f"{view_type}_{uuid.uuid4()}.jpg"
+    return filename, f"{animal_dir}/{filename}"
+
+
+def _scale_px_values(values: Optional[Dict[str, float]], scale: float) -> Optional[Dict[str, float]]:
+    if values is None or scale == 1.0:
+        return values
+    return {key: value * scale for key, value in values.items()}
+
+
+def _detect_marker(
+    animal_id: str, image: Optional[np.ndarray], scale: float = 1.0
+) -> Tuple[bool, Optional[float], Optional[Dict[str, float]], Optional[Dict[str, float]]]:
+    """Detect the ArUco marker, searching near this animal's last marker first when enabled.
+
+    scale is original px per image px (see _decode_upload); results are in original pixels.
+    """
+    search_bbox = None
+    if ARUCO_ROI_ENABLED:
+        with _marker_bbox_lock:
+            search_bbox = _marker_bbox_cache.get(animal_id)
+    detected, cm_per_px, marker_info, marker_bbox = detect_aruco_marker_with_bbox(
+        image, search_bbox=_scale_px_values(search_bbox, 1.0 / scale)
+    )
+    if cm_per_px is not None:
+        cm_per_px /= scale
+    marker_info = _scale_px_values(marker_info, scale)
+    marker_bbox = _scale_px_values(marker_bbox, scale)
+    if ARUCO_ROI_ENABLED and marker_bbox is not None:
+        with _marker_bbox_lock:
+            _marker_bbox_cache[animal_id] = marker_bbox
+    return detected, cm_per_px, marker_info, marker_bbox
+
+
+# Concurrent side-view uploads can share one batched pose forward pass, which
+# mostly pays off on a GPU. A request waits at most the window for others to
+# join its batch. Batching is off while the max batch size is 1.
+POSE_BATCH_MAX = int(os.getenv("ATC_POSE_BATCH_MAX", "1"))
+POSE_BATCH_WINDOW_SECONDS = float(os.getenv("ATC_POSE_BATCH_WINDOW_MS", "20")) / 1000.0
+
+
+class _PoseBatcher:
+    """Coalesces pose detection requests arriving within a short window into one batch."""
+
+    def __init__(self, max_batch: int, window_seconds: float) -> None:
+        self._max_batch = max_batch
+        self._window_seconds = window_seconds
+        self._pending: List[Tuple[Optional[np.ndarray], asyncio.Future]] = []
+        self._flush_handle: Optional[asyncio.TimerHandle] = None
+        # The loop only keeps weak references to tasks; hold them until they finish
+        self._tasks: Set[asyncio.Task] = set()
+
+    async def detect(self, image: Optional[np.ndarray]) -> Tuple[bool, List[PoseKeypoint]]:
+        # Only touched from the event loop thread, so no locking is needed.
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self._pending.append((image, future))
+        if len(self._pending) >= self._max_batch:
+            self._flush()
+        elif self._flush_handle is None:
+            self._flush_handle = loop.call_later(self._window_seconds, self._flush)
+        return await future
+
+    def _flush(self) -> None:
+        if self._flush_handle is not None:
+            self._flush_handle.cancel()
+            self._flush_handle = None
+        batch, self._pending = self._pending, []
+        if batch:
+            task = asyncio.ensure_future(self._run(batch))
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+
+    async def _run(self, batch: List[Tuple[Optional[np.ndarray], asyncio.Future]]) -> None:
+        try:
+            poses = await run_in_threadpool(detect_cattle_pose_batch, [image for image, _ in batch])
+        except Exception as exc:
+            for _, future in batch:
+                if not future.done():
+                    future.set_exception(exc)
+            return
+        for (_, future), pose in zip(batch, poses):
+            if not future.done():
+                future.set_result(pose)
+
+
+_pose_batcher = _PoseBatcher(POSE_BATCH_MAX, POSE_BATCH_WINDOW_SECONDS)
+
+
+async def _detect_pose(image: Optional[np.ndarray]) -> Tuple[bool, List[PoseKeypoint]]:
+    if POSE_BATCH_MAX <= 1:
+        return await run_in_threadpool(detect_cattle_pose_from_array, image)
+    return await _pose_batcher.detect(image)
+
+
+def _upload_response(response: AnimalUploadResponse) -> ORJSONResponse:
+    # The model is already validated; returning a Response directly skips
+    # FastAPI re-validating and re-serializing it against response_model.
+    return ORJSONResponse(response.model_dump())
+
+
+async def _process_upload(
+    data: AnimalUploadMetadata, image_bytes: bytes, background_tasks: BackgroundTasks
+) -> AnimalUploadResponse:
+    """Run detection and scoring on an uploaded image and save the resulting view."""
+    filename, filepath = _new_upload_path(data.animalID, data.viewType)
+    # Detection works on the decoded bytes, so the raw file only needs to be
+    # on disk eventually; write it after the response goes out.
+    background_tasks.add_task(_write_upload_bytes, filepath, image_bytes)
+
+    # Only process measurements and scoring for side view
+    if data.viewType == "side":
+        image, scale = await run_in_threadpool(_decode_upload, image_bytes)
+        # Marker and pose detection share the decoded image read-only and both
+        # release the GIL in native code, so run them side by side.
+        (detected, cm_per_px, marker_info, marker_bbox), (pose_success, image_keypoints) = await asyncio.gather(
+            run_in_threadpool(_detect_marker, data.animalID, image, scale),
+            _detect_pose(image),
+        )
+        # Keypoints in original pixels, matching cm_per_px; image_keypoints
+        # stay in decoded-image pixels for drawing
+        keypoints = scale_keypoints(image_keypoints, scale)
+
+        if not detected:
+            # ArUco not detected in side view - return error
             view = View(
                 viewType=data.viewType,
                 filename=filename,
                 uploaded_at=datetime.utcnow(),
                 confidence=0.0,
-                cm_per_px=cm_per_px if detected else None,
+                cm_per_px=None,
                 keypoints=[],
-                measurements={},  # No measurements for front/rear views
-                trait_scores={},  # No trait scores for front/rear views
-                score=None,  # No score for front/rear views
-                verdict="N/A",  # No verdict for front/rear views
+                measurements={},
+                trait_scores={},
+                score=None,
+                verdict="Poor",
                 debug_image_path=None,
-                aruco_detected=detected,
+                aruco_detected=False,
                 marker_size_px=marker_info,
             )
             
-            _save_view_to_db(data.animalID, view, data.breed, data.weight)
+            await run_in_threadpool(
+                _save_view_to_db, data.animalID, view, data.breed, data.weight, background_tasks
+            )
             
             return AnimalUploadResponse(
                 id=data.animalID,
@@ -400,68 +604,186 @@ async def upload_animal_data(data: AnimalUploadRequest):
                 viewType=data.viewType,
                 filename=filename,
                 confidence=0.0,
-                aruco_detected=detected,
-                cm_per_px=cm_per_px if detected else None,
+                aruco_detected=False,
+                cm_per_px=None,
                 keypoints=[],
                 measurements={},
                 trait_scores={},
                 final_score=None,
                 score=None,
-                verdict="N/A",
+                verdict="Poor",
                 debug_image_path=None,
                 marker_size_px=marker_info,
+                error_message="ArUco not detected – measurements unavailable",
+            )
+        
+        # ArUco detected - proceed with measurements
+        measurements, trait_scores = compute_measurements(keypoints, cm_per_px)
+        final_score = compute_final_score(trait_scores)
+        verdict = get_verdict(final_score)
+        confidence = _average_confidence(keypoints)
+
+        # Drawn on the already decoded upload after the response is sent; the
+        # path is reported up front whenever there is something to draw.
+        debug_image_path = None
+        if keypoints:
+            debug_image_path = f"{DEBUG_DIR}/{data.animalID}_{data.viewType}.jpg"
+            background_tasks.add_task(
+                draw_debug_image_from_array, image, image_keypoints, debug_image_path, KEYPOINT_NAMES
+            )
+
+        keypoint_payload = _convert_keypoints(keypoints)
+
+        view = View(
+            viewType=data.viewType,
+            filename=filename,
+            uploaded_at=datetime.utcnow(),
+            confidence=confidence,
+            cm_per_px=cm_per_px,
+            keypoints=keypoint_payload,
+            measurements=measurements,
+            trait_scores=trait_scores,
+            score=final_score,
+            verdict=verdict,
+            debug_image_path=debug_image_path,
+            aruco_detected=True,
+            marker_size_px=marker_info,
+            marker_bbox_px=marker_bbox,
+        )
+
+        await run_in_threadpool(
+            _save_view_to_db, data.animalID, view, data.breed, data.weight, background_tasks
+        )
+
+        return AnimalUploadResponse(
+            id=data.animalID,
+            status="saved",
+            viewType=data.viewType,
+            filename=filename,
+            confidence=confidence,
+            aruco_detected=True,
+            cm_per_px=cm_per_px,
+            keypoints=keypoint_payload,
+            measurements=measurements,
+            trait_scores=trait_scores,
+            final_score=final_score,
+            score=final_score,
+            verdict=verdict,
+            debug_image_path=debug_image_path,
+            marker_size_px=marker_info,
+        )
+    
+    else:
+        # Front or rear view - no measurements, just store with ArUco info.
+        # They don't use the scale, so only pay for detection when asked to.
+        if data.require_aruco:
+            image, scale = await run_in_threadpool(_decode_upload, image_bytes)
+            detected, cm_per_px, marker_info, marker_bbox = await run_in_threadpool(
+                _detect_marker, data.animalID, image, scale
             )
+        else:
+            detected, cm_per_px, marker_info, marker_bbox = False, None, None, None
+
+        view = View(
+            viewType=data.viewType,
+            filename=filename,
+            uploaded_at=datetime.utcnow(),
+            confidence=0.0,
+            cm_per_px=cm_per_px if detected else None,
+            keypoints=[],
+            measurements={},  # No measurements for front/rear views
+            trait_scores={},  # No trait scores for front/rear views
+            score=None,  # No score for front/rear views
+            verdict="N/A",  # No verdict for front/rear views
+            debug_image_path=None,
+            aruco_detected=detected,
+            marker_size_px=marker_info,
+            marker_bbox_px=marker_bbox,
+        )
+        
+        await run_in_threadpool(
+            _save_view_to_db, data.animalID, view, data.breed, data.weight, background_tasks
+        )
+        
+        return AnimalUploadResponse(
+            id=data.animalID,
+            status="saved",
+            viewType=data.viewType,
+            filename=filename,
+            confidence=0.0,
+            aruco_detected=detected,
+            cm_per_px=cm_per_px if detected else None,
+            keypoints=[],
+            measurements={},
+            trait_scores={},
+            final_score=None,
+            score=None,
+            verdict="N/A",
+            debug_image_path=None,
+            marker_size_px=marker_info,
+        )
+
 
+
+@app.post("/upload", response_model=AnimalUploadResponse)
+async def upload_animal_data(data: AnimalUploadRequest, background_tasks: BackgroundTasks):
+    """Upload animal data with view type and persist inference results."""
+    # Decoding, CV inference and persistence are all blocking; keep them on the
+    # threadpool so concurrent uploads don't serialize on the event loop.
+    try:
+        image_bytes = await run_in_threadpool(_decode_upload_base64, data.imageBase64)
+        return _upload_response(await _process_upload(data, image_bytes, background_tasks))
     except HTTPException:
         raise
     except Exception as exc:
         raise HTTPException(status_code=400, detail=f"Error processing upload: {exc}")
 
 
-@app.post("/animal/finalize", response_model=AnimalResponse)
-async def finalize_animal_record(payload: AnimalFinalizeRequest):
-    """Finalize an animal record by updating details and returning the latest snapshot."""
+@app.post("/upload/multipart", response_model=AnimalUploadResponse)
+async def upload_animal_data_multipart(
+    background_tasks: BackgroundTasks,
+    animalID: str = Form(...),
+    breed: str = Form(...),
+    weight: float = Form(...),
+    viewType: Literal["front", "side", "rear"] = Form(...),
+    require_aruco: bool = Form(False),
+    image: UploadFile = File(...),
+):
+    """Upload animal data as multipart/form-data with the raw image file."""
     try:
-        animal_doc: Optional[Dict[str, Any]] = None
-        try:
-            collection = get_animals_collection()
-            animal_doc = collection.find_one({"animalID": payload.animalID})
-        except Exception:
-            animal_doc = None
-
-        if not animal_doc:
-            animal_doc = _load_record_from_file(payload.animalID)
-
-        if not animal_doc:
-            raise HTTPException(status_code=404, detail="Animal not found")
-
-        views = animal_doc.get("views", [])
-
-        # Only use side view for final scoring
-        side_measurements = _get_side_view_measurements(views)
-        side_score = _get_side_view_score(views)
-        side_aruco_detected = _check_side_view_aruco(views)
+        data = AnimalUploadMetadata(
+            animalID=animalID,
+            breed=breed,
+            weight=weight,
+            viewType=viewType,
+            require_aruco=require_aruco,
+        )
+        image_bytes = await image.read()
+        return _upload_response(await _process_upload(data, image_bytes, background_tasks))
+    except HTTPException:
+        raise
+    except Exception as exc:
+        raise HTTPException(status_code=400, detail=f"Error processing upload: {exc}")
 
-        # Set final score and verdict based only on side view
-        if side_score is not None and side_aruco_detected:
-            final_score = side_score
-            final_verdict = get_verdict(final_score)
-        else:
-            final_score = 0.0
-            final_verdict = "Poor"
 
-        updates: Dict[str, Any] = {
+@app.post("/animal/finalize", response_model=AnimalResponse)
+async def finalize_animal_record(payload: AnimalFinalizeRequest, background_tasks: BackgroundTasks):
+    """Finalize an animal record by updating details and returning the latest snapshot."""
+    try:
+        details: Dict[str, Any] = {
             "breed": payload.breed,
             "weight": payload.weight,
-            "score": final_score,
-            "verdict": final_verdict,
-            "measurements": side_measurements,
             "timestamp": datetime.utcnow(),
         }
         if payload.farmerID:
-            updates["farmerID"] = payload.farmerID
-
-        record = _finalize_record(payload.animalID, updates, existing_record=animal_doc)
+            details["farmerID"] = payload.farmerID
+
+        record = await run_in_threadpool(
+            _finalize_record,
+            payload.animalID,
+            details,
+            background_tasks=background_tasks,
+        )
         return AnimalResponse(**record)
 
     except HTTPException:
@@ -474,12 +796,20 @@ async def finalize_animal_record(payload: AnimalFinalizeRequest):
 async def get_animal(animalID: str):
     """Get full animal record by animalID."""
     try:
-        collection = get_animals_collection()
-        animal_doc = collection.find_one({"animalID": animalID})
-        if not animal_doc:
-            raise HTTPException(status_code=404, detail="Animal not found")
-        if "_id" in animal_doc:
-            animal_doc["_id"] = str(animal_doc["_id"])
+        with _animal_cache_lock:
+            animal_doc = _animal_cache.get(animalID)
+            generation = _animal_cache_generations.get(animalID, 0)
+        if animal_doc is None:
+            collection = get_animals_collection()
+            animal_doc = await run_in_threadpool(collection.find_one, {"animalID": animalID})
+            if not animal_doc:
+                raise HTTPException(status_code=404, detail="Animal not found")
+            if "_id" in animal_doc:
+                animal_doc["_id"] = str(animal_doc["_id"])
+            with _animal_cache_lock:
+                # Only cache if no write landed while the document was read
+                if _animal_cache_generations.get(animalID, 0) == generation:
+                    _animal_cache[animalID] = animal_doc
         return AnimalResponse(**animal_doc)
     except HTTPException:
         raise
@@ -498,10 +828,10 @@ async def health_check():
     """Health check endpoint with MongoDB status."""
     try:
         collection = get_animals_collection()
-        collection.find_one()
-        return {"status": "healthy", "uploads_dir": "uploads", "mongodb": "connected"}
+        await run_in_threadpool(collection.find_one)
+        return {"status": "healthy", "uploads_dir": UPLOAD_ROOT, "mongodb": "connected"}
     except Exception as exc:
-        return {"status": "unhealthy", "uploads_dir": "uploads", "mongodb": f"error: {exc}"}
+        return {"status": "unhealthy", "uploads_dir": UPLOAD_ROOT, "mongodb": f"error: {exc}"}
 
 
 if __name__ == "__main__":
@@ -1,11 +1,13 @@
 from datetime import datetime
 from typing import List, Dict, Optional, Literal
-from pydantic import BaseModel, Field
+from pydantic import BaseModel, ConfigDict, Field
 
 
 class Keypoint(BaseModel):
     """Represents a single keypoint with position and confidence."""
 
+    model_config = ConfigDict(frozen=True)
+
     name: Optional[str] = None
     x: float
     y: float
@@ -28,11 +30,15 @@ class View(BaseModel):
     debug_image_path: Optional[str] = None
     aruco_detected: bool = False
     marker_size_px: Optional[Dict[str, float]] = None  # {"width_px": float, "height_px": float, "avg_side_px": float}
+    marker_bbox_px: Optional[Dict[str, float]] = None  # {"x_min": float, "y_min": float, "x_max": float, "y_max": float}
 
 
 class AnimalRecord(BaseModel):
     """Complete animal record with all data."""
 
+    # Stored documents carry Mongo's _id alongside the model fields.
+    model_config = ConfigDict(extra='ignore')
+
     animalID: str
     breed: str
     weight: float
@@ -44,14 +50,20 @@ class AnimalRecord(BaseModel):
     timestamp: datetime = Field(default_factory=datetime.utcnow)
 
 
-class AnimalUploadRequest(BaseModel):
-    """Request model for animal upload."""
+class AnimalUploadMetadata(BaseModel):
+    """Animal and view details sent alongside an uploaded image."""
 
     animalID: str
     breed: str
     weight: float
-    imageBase64: str
     viewType: Literal['front', 'side', 'rear']
+    require_aruco: bool = False  # Run marker detection on front/rear views too
+
+
+class AnimalUploadRequest(AnimalUploadMetadata):
+    """Request model for animal upload."""
+
+    imageBase64: str
 
 
 class AnimalUploadResponse(BaseModel):
@@ -78,6 +90,9 @@ class AnimalUploadResponse(BaseModel):
 class AnimalResponse(BaseModel):
     """Response model for getting animal data."""
 
+    # Stored documents carry Mongo's _id alongside the model fields.
+    model_config = ConfigDict(extra='ignore')
+
     animalID: str
     breed: str
     weight: float
@@ -1,12 +1,33 @@
+import math
 import os
+import threading
+from dataclasses import dataclass
 from pathlib import Path
-from typing import Dict, List, Optional, Tuple
+from typing import Dict, List, Optional, Tuple, Union
 
 import cv2
 import numpy as np
+import torch
+from PIL import Image
 from ultralytics import YOLO
 
 POSE_MODEL_PATH = Path("runs/pose/cattle_pose_train4/weights/best.pt")
+POSE_ENGINE_PATH = POSE_MODEL_PATH.with_suffix(".engine")
+
+# Build a TensorRT FP16 engine from the trained weights on first load when
+# running on a GPU. Exporting takes minutes and needs TensorRT installed, so
+# it is opt-in; an engine that already exists is always preferred on CUDA.
+POSE_TRT_EXPORT = os.getenv("ATC_POSE_TRT_EXPORT", "0") == "1"
+# Largest batch the engine accepts; keep in step with the API's request batching.
+POSE_ENGINE_MAX_BATCH = max(1, int(os.getenv("ATC_POSE_BATCH_MAX", "1")))
+
+# INT8 post-training quantization for CPU/edge servers. This Ultralytics
+# release only quantizes through OpenVINO (NNCF calibration on the dataset's
+# val split); TensorRT engines stay FP16. Opt-in, since calibration is slow
+# and pulls in openvino-dev/nncf; an existing INT8 model is reused.
+POSE_INT8 = os.getenv("ATC_POSE_INT8", "0") == "1"
+POSE_INT8_DATA = os.getenv("ATC_POSE_INT8_DATA", "cattle_pose.yaml")
+POSE_INT8_MODEL_PATH = POSE_MODEL_PATH.with_name(f"{POSE_MODEL_PATH.stem}_int8_openvino_model")
 
 MIN_KEYPOINT_CONFIDENCE = 0.1
 
@@ -25,6 +46,8 @@ KEYPOINT_NAMES: List[str] = [
     "tail_tip",
 ]
 
+KEYPOINT_NAMES_TUPLE: Tuple[str, ...] = tuple(KEYPOINT_NAMES)
+
 KEYPOINT_INDEX: Dict[str, int] = {name: idx for idx, name in enumerate(KEYPOINT_NAMES)}
 CATTLE_KEYPOINTS: Dict[str, int] = KEYPOINT_INDEX.copy()
 
@@ -42,18 +65,51 @@ SKELETON_CONNECTIONS: List[Tuple[int, int]] = [
     (KEYPOINT_INDEX["back_center"], KEYPOINT_INDEX["tail_root"]),
 ]
 
+# (edges, 2) endpoint indices, for picking all skeleton segments in one go.
+_SKELETON_INDEX = np.array(SKELETON_CONNECTIONS, dtype=np.intp)
+
+# Debug images are for eyeballing keypoints; JPEG at this quality encodes
+# around 10x faster than PNG and is far smaller on disk.
+DEBUG_IMAGE_JPEG_QUALITY = int(os.getenv("ATC_DEBUG_JPEG_QUALITY", "85"))
+DEBUG_IMAGE_WRITE_PARAMS = [cv2.IMWRITE_JPEG_QUALITY, DEBUG_IMAGE_JPEG_QUALITY]
+
+# Row of the stock COCO pose output that feeds each entry of KEYPOINT_NAMES.
+_COCO_TO_CATTLE_INDEX = np.array([0, 1, 2, 5, 11, 12, 13, 14, 6, 8, 7, 10], dtype=np.intp)
+_COCO_MAX_INDEX = int(_COCO_TO_CATTLE_INDEX.max())
+
 YOLO_INFERENCE_CONFIDENCE = float(os.getenv("ATC_POSE_CONF", "0.10"))
 YOLO_INFERENCE_IOU = float(os.getenv("ATC_POSE_IOU", "0.5"))
 YOLO_MAX_DETECTIONS = int(os.getenv("ATC_POSE_MAX_DET", "1"))
 
+# Run one throwaway inference after loading so predictor setup, layer fusion
+# and CUDA/cuDNN initialization don't land on the first real request.
+POSE_WARMUP = os.getenv("ATC_POSE_WARMUP", "1") != "0"
+
+# On GPU hosts torch's CPU pool only does light pre/post-processing and its
+# threads contend with the API's worker threads, so keep it small.
+if torch.cuda.is_available():
+    torch.set_num_threads(int(os.getenv("ATC_TORCH_THREADS", "1")))
+POSE_WARMUP_IMGSZ = 640
+
+# Image paths much larger than the inference size are decoded by libjpeg at
+# 1/2, 1/4 or 1/8 scale (DCT scaling) instead of at full resolution only to
+# be shrunk to imgsz; keypoints are scaled back to original pixels.
+POSE_IMGSZ = 640
+_REDUCED_DECODE_FLAGS = (
+    (8, cv2.IMREAD_REDUCED_COLOR_8),
+    (4, cv2.IMREAD_REDUCED_COLOR_4),
+    (2, cv2.IMREAD_REDUCED_COLOR_2),
+)
 
+
+@dataclass(slots=True)
 class Keypoint:
     """Represents a single keypoint with position and confidence."""
 
-    def __init__(self, x: float, y: float, confidence: float) -> None:
-        self.x = float(x)
-        self.y = float(y)
-        self.confidence = float(confidence)
+    # Built from ndarray.tolist() rows, so fields are already Python floats
+    x: float
+    y: float
+    confidence: float
 
     def to_tuple(self) -> Tuple[float, float]:
         return self.x, self.y
@@ -71,7 +127,12 @@ class PoseDetector:
     def __init__(self, model_path: Optional[str] = None) -> None:
         self.model: Optional[YOLO] = None
         self.model_path: Optional[str] = None
+        # The Ultralytics predictor keeps per-call state on the model, so
+        # concurrent predict() calls from worker threads must not overlap.
+        self._predict_lock = threading.Lock()
         self._load_model(model_path)
+        if self.model is not None and POSE_WARMUP:
+            self._warmup()
 
     @staticmethod
     def _dedupe_paths(paths: List[Path]) -> List[Path]:
@@ -85,7 +146,29 @@ class PoseDetector:
         return ordered
 
     def _default_model_paths(self) -> List[Path]:
-        return [POSE_MODEL_PATH]
+        if not torch.cuda.is_available():
+            if POSE_INT8:
+                calibrate_int8()
+                return [POSE_INT8_MODEL_PATH, POSE_MODEL_PATH]
+            return [POSE_MODEL_PATH]
+        self._ensure_engine()
+        return [POSE_ENGINE_PATH, POSE_MODEL_PATH]
+
+    @staticmethod
+    def _ensure_engine() -> None:
+        if not POSE_TRT_EXPORT or POSE_ENGINE_PATH.exists() or not POSE_MODEL_PATH.exists():
+            return
+        try:
+            YOLO(str(POSE_MODEL_PATH)).export(
+                format="engine",
+                half=True,
+                dynamic=True,
+                workspace=4,
+                batch=POSE_ENGINE_MAX_BATCH,
+            )
+            print(f"[Pose Estimation] Exported TensorRT engine: {POSE_ENGINE_PATH}")
+        except Exception as exc:
+            print(f"Failed exporting TensorRT engine: {exc}")
 
     def _load_model(self, explicit_path: Optional[str]) -> None:
         search_order: List[Path] = []
@@ -99,7 +182,7 @@ class PoseDetector:
                 try:
                     self.model = YOLO(str(candidate))
                     self.model_path = str(candidate)
-                    print("[Pose Estimation] Loaded model: runs/pose/cattle_pose_train4/weights/best.pt")
+                    print(f"[Pose Estimation] Loaded model: {candidate}")
                     return
                 except Exception as exc:
                     print(f"Failed loading model '{candidate}': {exc}")
@@ -113,89 +196,145 @@ class PoseDetector:
             self.model = None
             self.model_path = None
 
-    def _parse_keypoints(self, raw_keypoints) -> List[Keypoint]:
+    def _warmup(self) -> None:
+        try:
+            self._predict(np.zeros((POSE_WARMUP_IMGSZ, POSE_WARMUP_IMGSZ, 3), dtype=np.uint8))
+        except Exception as exc:
+            print(f"Pose model warmup failed: {exc}")
+
+    def _parse_keypoints(self, raw_keypoints, scale: float = 1.0) -> List[Keypoint]:
         if raw_keypoints is None:
             return []
-        if hasattr(raw_keypoints, "cpu"):
-            raw_keypoints = raw_keypoints.cpu().numpy()
+        if hasattr(raw_keypoints, "detach"):
+            # One device-to-host copy; detach so numpy() never trips on autograd
+            raw_keypoints = raw_keypoints.detach().cpu().numpy()
         raw_array = np.asarray(raw_keypoints)
         if raw_array.ndim == 3:
             raw_array = raw_array[0]
+        if scale != 1.0:
+            # Out of place: raw_array may share memory with the result tensor
+            raw_array = np.column_stack((raw_array[:, :2] * scale, raw_array[:, 2:]))
 
         if raw_array.shape[0] == len(KEYPOINT_NAMES):
-            keypoints: List[Keypoint] = []
-            for row in raw_array:
-                x = float(row[0])
-                y = float(row[1])
-                conf = float(row[2]) if len(row) > 2 else 1.0
-                keypoints.append(Keypoint(x, y, conf))
-            return keypoints
+            if raw_array.shape[1] < 3:
+                # No confidence column; treat every point as certain
+                raw_array = np.column_stack((raw_array[:, :2], np.ones(len(raw_array))))
+            # One tolist() converts every value to a Python float in C
+            return [Keypoint(x, y, conf) for x, y, conf in raw_array[:, :3].tolist()]
 
         return self._map_coco_to_cattle_keypoints(raw_array)
 
-    def detect_pose(self, image_path: str) -> Tuple[bool, List[Keypoint]]:
-        if self.model is None:
-            return False, []
-
-        try:
-            results = self.model.predict(
-                source=image_path,
+    def _predict(self, source):
+        with self._predict_lock:
+            return self.model.predict(
+                source=source,
                 conf=YOLO_INFERENCE_CONFIDENCE,
                 iou=YOLO_INFERENCE_IOU,
                 max_det=YOLO_MAX_DETECTIONS,
                 verbose=False,
             )
-            if not results:
-                return False, []
 
-            result = results[0]
-            keypoints_tensor = getattr(result, "keypoints", None)
-            if keypoints_tensor is None or keypoints_tensor.data is None or len(keypoints_tensor.data) == 0:
-                return False, []
+    @staticmethod
+    def _load_source(source: Union[str, np.ndarray]) -> Tuple[Union[str, np.ndarray], float]:
+        """Decode large image paths at reduced scale; returns (source, keypoint scale)."""
+        if not isinstance(source, str):
+            return source, 1.0
+        try:
+            # Header-only read; pixels are not decoded here
+            with Image.open(source) as header:
+                longest_side = max(header.size)
+        except Exception:
+            return source, 1.0
+        for factor, flag in _REDUCED_DECODE_FLAGS:
+            if longest_side >= factor * POSE_IMGSZ:
+                image = cv2.imread(source, flag)
+                if image is None:
+                    break
+                return image, longest_side / max(image.shape[:2])
+        return source, 1.0
+
+    def _result_to_pose(self, result, scale: float = 1.0) -> Tuple[bool, List[Keypoint]]:
+        keypoints_tensor = getattr(result, "keypoints", None)
+        if keypoints_tensor is None or keypoints_tensor.data is None or len(keypoints_tensor.data) == 0:
+            return False, []
 
-            keypoints = self._parse_keypoints(keypoints_tensor.data)
-            if not keypoints:
-                return False, []
+        keypoints = self._parse_keypoints(keypoints_tensor.data, scale)
+        if not keypoints:
+            return False, []
+
+        valid_conf = [kp for kp in keypoints if kp.confidence >= MIN_KEYPOINT_CONFIDENCE]
+        success = len(valid_conf) >= 4
+        return success, keypoints
+
+    # Covers keypoint post-processing too, not just Ultralytics' own forward pass
+    @torch.inference_mode()
+    def detect_pose(self, source: Union[str, np.ndarray]) -> Tuple[bool, List[Keypoint]]:
+        """Detect keypoints in an image path or an already decoded BGR array."""
+        if self.model is None or source is None:
+            return False, []
 
-            valid_conf = [kp for kp in keypoints if kp.confidence >= MIN_KEYPOINT_CONFIDENCE]
-            success = len(valid_conf) >= 4
-            return success, keypoints
+        try:
+            source, scale = self._load_source(source)
+            results = self._predict(source)
+            if not results:
+                return False, []
+            return self._result_to_pose(results[0], scale)
 
         except Exception as exc:
             print(f"Error detecting pose: {exc}")
             return False, []
 
+    @torch.inference_mode()
+    def detect_pose_batch(self, sources: List[Union[str, np.ndarray]]) -> List[Tuple[bool, List[Keypoint]]]:
+        """Detect keypoints in several images with a single batched forward pass."""
+        poses: List[Tuple[bool, List[Keypoint]]] = [(False, []) for _ in sources]
+        indexed = [(idx, source) for idx, source in enumerate(sources) if source is not None]
+        if self.model is None or not indexed:
+            return poses
+
+        try:
+            loaded = [self._load_source(source) for _, source in indexed]
+            results = self._predict([source for source, _ in loaded])
+            for (idx, _), (_, scale), result in zip(indexed, loaded, results):
+                poses[idx] = self._result_to_pose(result, scale)
+        except Exception as exc:
+            print(f"Error detecting pose batch: {exc}")
+        return poses
+
     def _map_coco_to_cattle_keypoints(self, coco_keypoints) -> List[Keypoint]:
-        mapping = {
-            "muzzle": 0,
-            "left_eye": 1,
-            "right_eye": 2,
-            "neck": 5,
-            "front_left_hoof": 11,
-            "front_right_hoof": 12,
-            "rear_left_hoof": 13,
-            "rear_right_hoof": 14,
-            "backbone": 6,
-            "tail_root": 8,
-            "back_center": 7,
-            "tail_tip": 10,
-        }
-
-        keypoints: List[Keypoint] = []
-        for name in KEYPOINT_NAMES:
-            coco_idx = mapping.get(name, 0)
-            if coco_idx < len(coco_keypoints):
-                row = coco_keypoints[coco_idx]
-                x = float(row[0])
-                y = float(row[1])
-                conf = float(row[2]) if len(row) > 2 else 0.0
-                if conf < MIN_KEYPOINT_CONFIDENCE:
-                    keypoints.append(Keypoint(0.0, 0.0, 0.0))
-                else:
-                    keypoints.append(Keypoint(x, y, conf))
-            else:
-                keypoints.append(Keypoint(0.0, 0.0, 0.0))
+        coco_array = np.asarray(coco_keypoints)
+        if len(coco_array) > _COCO_MAX_INDEX and coco_array.shape[1] >= 3:
+            # Fancy indexing copies, so masking below leaves the input alone
+            rows = coco_array[_COCO_TO_CATTLE_INDEX, :3]
+        else:
+            # Keypoints the model didn't output, and a missing confidence
+            # column, stay zero and so count as undetected.
+            rows = np.zeros((len(_COCO_TO_CATTLE_INDEX), 3), dtype=np.float64)
+            available = _COCO_TO_CATTLE_INDEX < len(coco_array)
+            num_cols = min(coco_array.shape[1], 3)
+            rows[available, :num_cols] = coco_array[_COCO_TO_CATTLE_INDEX[available], :num_cols]
+        rows[rows[:, 2] < MIN_KEYPOINT_CONFIDENCE] = 0.0
+        return [Keypoint(x, y, conf) for x, y, conf in rows.tolist()]
+
+
+def scale_keypoints(keypoints: List[Keypoint], scale: float) -> List[Keypoint]:
+    """Keypoints with x/y multiplied by scale, e.g. from a reduced-size decode back to original pixels."""
+    if scale == 1.0:
         return keypoints
+    return [Keypoint(kp.x * scale, kp.y * scale, kp.confidence) for kp in keypoints]
+
+
+def keypoints_confidence_array(keypoints: List[Keypoint]) -> np.ndarray:
+    return np.fromiter((kp.confidence for kp in keypoints), dtype=np.float64, count=len(keypoints))
+
+
+def keypoints_to_array(keypoints: List[Keypoint]) -> np.ndarray:
+    """Pack keypoints into an (N, 3) array with columns x, y, confidence."""
+    return np.fromiter(
+        ((kp.x, kp.y, kp.confidence) for kp in keypoints),
+        dtype=np.dtype((np.float64, 3)),
+        count=len(keypoints),
+    )
 
 
 def _is_valid(kp: Optional[Keypoint]) -> bool:
@@ -206,18 +345,22 @@ def _round(value: float, ndigits: int) -> float:
     return float(round(value, ndigits))
 
 
+# Scalar 2D math: plain floats through the math module avoid allocating tiny
+# NumPy arrays and dispatching ufuncs for every measurement.
 def _distance(a: Keypoint, b: Keypoint) -> float:
-    return float(np.linalg.norm([a.x - b.x, a.y - b.y]))
+    return math.hypot(a.x - b.x, a.y - b.y)
 
 
 def _angle(a: Keypoint, b: Keypoint, c: Keypoint) -> Optional[float]:
-    ab = np.array([a.x - b.x, a.y - b.y], dtype=float)
-    cb = np.array([c.x - b.x, c.y - b.y], dtype=float)
-    if np.linalg.norm(ab) == 0 or np.linalg.norm(cb) == 0:
+    abx, aby = a.x - b.x, a.y - b.y
+    cbx, cby = c.x - b.x, c.y - b.y
+    ab_norm = math.hypot(abx, aby)
+    cb_norm = math.hypot(cbx, cby)
+    if ab_norm == 0 or cb_norm == 0:
         return None
-    cos_angle = np.dot(ab, cb) / (np.linalg.norm(ab) * np.linalg.norm(cb))
-    cos_angle = np.clip(cos_angle, -1.0, 1.0)
-    return float(np.degrees(np.arccos(cos_angle)))
+    cos_angle = (abx * cbx + aby * cby) / (ab_norm * cb_norm)
+    cos_angle = min(1.0, max(-1.0, cos_angle))
+    return math.degrees(math.acos(cos_angle))
 
 
 def _norm_linear(value: float, low: float, high: float) -> float:
@@ -304,24 +447,18 @@ def compute_measurements(
     return measurements, trait_scores
 
 
-def draw_debug_image(
-    image_path: str,
-    keypoints: List[Keypoint],
-    output_path: str,
-    names: Optional[List[str]] = None,
-) -> Optional[str]:
-    if not keypoints or not os.path.exists(image_path):
-        return None
-
-    image = cv2.imread(image_path)
-    if image is None:
-        return None
+def _annotate_keypoints(image: np.ndarray, keypoints: List[Keypoint], names: List[str]) -> None:
+    # Round every point and test visibility in one pass over the packed array;
+    # np.rint rounds half to even, same as round().
+    kps = keypoints_to_array(keypoints)
+    visible_mask = kps[:, 2] >= MIN_KEYPOINT_CONFIDENCE
+    visible = visible_mask.tolist()
+    pixel_array = np.rint(kps[:, :2]).astype(np.int32)
+    pixels = [tuple(point) for point in pixel_array.tolist()]
 
-    names = names or KEYPOINT_NAMES
-    for idx, kp in enumerate(keypoints):
-        if kp.confidence < MIN_KEYPOINT_CONFIDENCE:
+    for idx, center in enumerate(pixels):
+        if not visible[idx]:
             continue
-        center = (int(round(kp.x)), int(round(kp.y)))
         cv2.circle(image, center, 5, (0, 255, 0), thickness=-1)
         label = names[idx] if idx < len(names) else str(idx)
         cv2.putText(
@@ -335,32 +472,98 @@ def draw_debug_image(
             lineType=cv2.LINE_AA,
         )
 
-    for start_idx, end_idx in SKELETON_CONNECTIONS:
-        if start_idx >= len(keypoints) or end_idx >= len(keypoints):
-            continue
-        start = keypoints[start_idx]
-        end = keypoints[end_idx]
-        if start.confidence < MIN_KEYPOINT_CONFIDENCE or end.confidence < MIN_KEYPOINT_CONFIDENCE:
-            continue
-        pt1 = (int(round(start.x)), int(round(start.y)))
-        pt2 = (int(round(end.x)), int(round(end.y)))
-        cv2.line(image, pt1, pt2, (0, 165, 255), thickness=2, lineType=cv2.LINE_AA)
+    # Keep edges whose endpoints both exist and are visible, then draw all of
+    # them as two-point polylines in a single call.
+    edges = _SKELETON_INDEX[(_SKELETON_INDEX < len(pixels)).all(axis=1)]
+    edges = edges[visible_mask[edges].all(axis=1)]
+    if len(edges):
+        segments = pixel_array[edges].reshape(-1, 2, 1, 2)
+        cv2.polylines(image, list(segments), False, (0, 165, 255), thickness=2, lineType=cv2.LINE_AA)
 
+
+def _write_debug_image(image: np.ndarray, keypoints: List[Keypoint], output_path: str, names: Optional[List[str]]) -> Optional[str]:
+    _annotate_keypoints(image, keypoints, names or KEYPOINT_NAMES)
     os.makedirs(Path(output_path).parent, exist_ok=True)
-    cv2.imwrite(output_path, image)
+    # Quality only applies to .jpg outputs; other formats ignore it
+    if not cv2.imwrite(output_path, image, DEBUG_IMAGE_WRITE_PARAMS):
+        return None
     return output_path
 
 
+def draw_debug_image(
+    image_path: str,
+    keypoints: List[Keypoint],
+    output_path: str,
+    names: Optional[List[str]] = None,
+) -> Optional[str]:
+    if not keypoints or not os.path.exists(image_path):
+        return None
+
+    image = cv2.imread(image_path)
+    if image is None:
+        return None
+
+    return _write_debug_image(image, keypoints, output_path, names)
+
+
+def draw_debug_image_from_array(
+    image: Optional[np.ndarray],
+    keypoints: List[Keypoint],
+    output_path: str,
+    names: Optional[List[str]] = None,
+) -> Optional[str]:
+    if not keypoints or image is None:
+        return None
+
+    # Draw on a copy; the caller's array may be shared with other detectors.
+    return _write_debug_image(image.copy(), keypoints, output_path, names)
+
+
 _pose_detector: Optional[PoseDetector] = None
+_pose_detector_lock = threading.Lock()
+
+
+def calibrate_int8(model_path: Path = POSE_MODEL_PATH, data: str = POSE_INT8_DATA) -> Optional[Path]:
+    """Export an INT8 OpenVINO model calibrated on data's val images (skipped if present)."""
+    int8_path = model_path.with_name(f"{model_path.stem}_int8_openvino_model")
+    if int8_path.exists():
+        return int8_path
+    if not model_path.exists():
+        return None
+    try:
+        YOLO(str(model_path)).export(
+            format="openvino",
+            int8=True,
+            data=data,
+            dynamic=POSE_ENGINE_MAX_BATCH > 1,
+        )
+        print(f"[Pose Estimation] Exported INT8 OpenVINO model: {int8_path}")
+        return int8_path
+    except Exception as exc:
+        print(f"Failed exporting INT8 model: {exc}")
+        return None
 
 
 def get_pose_detector() -> PoseDetector:
     global _pose_detector
     if _pose_detector is None:
-        _pose_detector = PoseDetector()
+        # Double-checked: concurrent first calls must not each load the model
+        with _pose_detector_lock:
+            if _pose_detector is None:
+                _pose_detector = PoseDetector()
     return _pose_detector
 
 
 def detect_cattle_pose(image_path: str) -> Tuple[bool, List[Keypoint]]:
     detector = get_pose_detector()
     return detector.detect_pose(image_path)
+
+
+def detect_cattle_pose_from_array(image: Optional[np.ndarray]) -> Tuple[bool, List[Keypoint]]:
+    detector = get_pose_detector()
+    return detector.detect_pose(image)
+
+
+def detect_cattle_pose_batch(images: List[Optional[np.ndarray]]) -> List[Tuple[bool, List[Keypoint]]]:
+    detector = get_pose_detector()
+    return detector.detect_pose_batch(images)
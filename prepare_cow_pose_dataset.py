@@ -3,14 +3,17 @@
 Convert Kaggle Cow Pose Estimation dataset from COCO format to YOLOv8 pose format
 """
 
-import json
 import os
 import shutil
 from pathlib import Path
 import cv2
 import numpy as np
-from typing import Dict, List, Tuple
+import orjson
+from typing import Dict, List, Optional, Tuple
 import argparse
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import nullcontext
+from functools import partial
 
 def create_directory_structure(base_path: str):
     """Create the required directory structure for YOLOv8 pose dataset"""
@@ -27,7 +30,94 @@ def create_directory_structure(base_path: str):
         os.makedirs(os.path.join(base_path, dir_path), exist_ok=True)
         print(f"Created directory: {dir_path}")
 
-def convert_coco_to_yolo_pose(coco_json_path: str, images_dir: str, output_dir: str, split: str = "train"):
+def _link_or_copy(src: str, dst: str):
+    """Hardlink src to dst (no byte copy), falling back to a copy across filesystems"""
+    # Images already in the output tree (images dir == output split dir)
+    if os.path.exists(dst) and os.path.samefile(src, dst):
+        return
+    # Link/copy under a temp name and swap it in, so an existing dst is only
+    # replaced once the new file is complete
+    tmp = f"{dst}.{os.getpid()}.tmp"
+    try:
+        try:
+            os.link(src, tmp)
+        except OSError:
+            shutil.copy2(src, tmp)
+        os.replace(tmp, dst)
+    finally:
+        if os.path.lexists(tmp):
+            os.remove(tmp)
+
+def _convert_image(image_info: Dict, annotations: List[Dict], images_dir: str, output_dir: str, split: str) -> bool:
+    """Copy one image and write its YOLO pose label file; returns False if skipped"""
+    image_filename = image_info['file_name']
+    image_path = os.path.join(images_dir, image_filename)
+    
+    if not os.path.exists(image_path):
+        print(f"Warning: Image not found: {image_path}")
+        return False
+    
+    # COCO already records the dimensions; only decode the image if it doesn't
+    img_width = image_info.get('width')
+    img_height = image_info.get('height')
+    if not img_width or not img_height:
+        img = cv2.imread(image_path)
+        if img is None:
+            print(f"Warning: Could not load image: {image_path}")
+            return False
+        img_height, img_width = img.shape[:2]
+    
+    # Create YOLO format label file
+    label_filename = os.path.splitext(image_filename)[0] + '.txt'
+    label_path = os.path.join(output_dir, 'labels', split, label_filename)
+    
+    # Copy image to output directory
+    output_image_path = os.path.join(output_dir, 'images', split, image_filename)
+    _link_or_copy(image_path, output_image_path)
+    
+    # Process annotations for this image
+    yolo_lines = []
+    for ann in annotations:
+        if 'keypoints' not in ann or len(ann['keypoints']) == 0:
+            continue
+            
+        # Get bounding box
+        bbox = ann['bbox']  # [x, y, width, height]
+        x, y, w, h = bbox
+        
+        # Convert to YOLO format (normalized center coordinates)
+        center_x = (x + w/2) / img_width
+        center_y = (y + h/2) / img_height
+        norm_w = w / img_width
+        norm_h = h / img_height
+        
+        # Normalize keypoints: [x1, y1, v1, x2, y2, v2, ...] -> rows of (x, y, v)
+        keypoints = ann['keypoints']
+        num_keypoints = len(keypoints) // 3
+        kps = np.asarray(keypoints[:num_keypoints * 3], dtype=np.float64).reshape(-1, 3)
+        kps[:, 0] /= img_width
+        kps[:, 1] /= img_height
+        
+        # YOLO format: x, y, v (where v=0 if not visible, v=1 if visible, v=2 if occluded)
+        vis = np.where(kps[:, 2] == 0, 0, np.where(kps[:, 2] == 1, 1, 2))
+        
+        # Create YOLO pose line: class_id center_x center_y width height kpt1_x kpt1_y kpt1_v ...
+        # Fixed 6 decimals (sub-pixel at any realistic resolution) instead of full float repr
+        class_id = 0  # Assuming single class (cow)
+        yolo_line = f"{class_id} {center_x:.6f} {center_y:.6f} {norm_w:.6f} {norm_h:.6f}"
+        if len(kps):
+            yolo_line += " " + " ".join(
+                f"{x:.6f} {y:.6f} {v}" for x, y, v in zip(kps[:, 0].tolist(), kps[:, 1].tolist(), vis.tolist())
+            )
+        yolo_lines.append(yolo_line)
+    
+    # Write label file
+    with open(label_path, 'w') as f:
+        f.write('\n'.join(yolo_lines))
+    
+    return True
+
+def convert_coco_to_yolo_pose(coco_json_path: str, images_dir: str, output_dir: str, split: str = "train", workers: Optional[int] = None):
     """
     Convert COCO format annotations to YOLOv8 pose format
     
@@ -36,11 +126,12 @@ def convert_coco_to_yolo_pose(coco_json_path: str, images_dir: str, output_dir:
         images_dir: Directory containing images
         output_dir: Output directory for YOLO format files
         split: Dataset split (train/val/test)
+        workers: Worker processes for the per-image conversion (default: CPU count, 1 = no pool)
     """
     
-    # Load COCO annotations
-    with open(coco_json_path, 'r') as f:
-        coco_data = json.load(f)
+    # Load COCO annotations (orjson parses large annotation files several times faster)
+    with open(coco_json_path, 'rb') as f:
+        coco_data = orjson.loads(f.read())
     
     # Create mappings
     images = {img['id']: img for img in coco_data['images']}
@@ -56,82 +147,21 @@ def convert_coco_to_yolo_pose(coco_json_path: str, images_dir: str, output_dir:
     
     print(f"Processing {len(annotations_by_image)} images for {split} split...")
     
-    # Process each image
+    # Every image is independent (decode, copy, label write), so spread them
+    # across processes; only each image's own info and annotations are sent.
+    image_infos = [images[image_id] for image_id in annotations_by_image]
+    convert = partial(_convert_image, images_dir=images_dir, output_dir=output_dir, split=split)
+    workers = workers or os.cpu_count() or 1
+    
     processed_count = 0
-    for image_id, annotations in annotations_by_image.items():
-        image_info = images[image_id]
-        image_filename = image_info['file_name']
-        image_path = os.path.join(images_dir, image_filename)
-        
-        if not os.path.exists(image_path):
-            print(f"Warning: Image not found: {image_path}")
-            continue
-        
-        # Load image to get dimensions
-        img = cv2.imread(image_path)
-        if img is None:
-            print(f"Warning: Could not load image: {image_path}")
-            continue
-            
-        img_height, img_width = img.shape[:2]
-        
-        # Create YOLO format label file
-        label_filename = os.path.splitext(image_filename)[0] + '.txt'
-        label_path = os.path.join(output_dir, 'labels', split, label_filename)
-        
-        # Copy image to output directory
-        output_image_path = os.path.join(output_dir, 'images', split, image_filename)
-        shutil.copy2(image_path, output_image_path)
-        
-        # Process annotations for this image
-        yolo_lines = []
-        for ann in annotations:
-            if 'keypoints' not in ann or len(ann['keypoints']) == 0:
+    with ProcessPoolExecutor(max_workers=workers) if workers > 1 else nullcontext() as executor:
+        mapper = partial(executor.map, chunksize=32) if executor is not None else map
+        for converted in mapper(convert, image_infos, annotations_by_image.values()):
+            if not converted:
                 continue
-                
-            # Get bounding box
-            bbox = ann['bbox']  # [x, y, width, height]
-            x, y, w, h = bbox
-            
-            # Convert to YOLO format (normalized center coordinates)
-            center_x = (x + w/2) / img_width
-            center_y = (y + h/2) / img_height
-            norm_w = w / img_width
-            norm_h = h / img_height
-            
-            # Process keypoints
-            keypoints = ann['keypoints']  # [x1, y1, v1, x2, y2, v2, ...]
-            num_keypoints = len(keypoints) // 3
-            
-            # Normalize keypoints
-            normalized_keypoints = []
-            for i in range(num_keypoints):
-                x_kpt = keypoints[i*3] / img_width
-                y_kpt = keypoints[i*3 + 1] / img_height
-                visibility = keypoints[i*3 + 2]
-                
-                # YOLO format: x, y, v (where v=0 if not visible, v=1 if visible, v=2 if occluded)
-                if visibility == 0:
-                    v = 0  # not labeled
-                elif visibility == 1:
-                    v = 1  # labeled and visible
-                else:
-                    v = 2  # labeled but occluded
-                
-                normalized_keypoints.extend([x_kpt, y_kpt, v])
-            
-            # Create YOLO pose line: class_id center_x center_y width height kpt1_x kpt1_y kpt1_v ...
-            class_id = 0  # Assuming single class (cow)
-            yolo_line = [class_id, center_x, center_y, norm_w, norm_h] + normalized_keypoints
-            yolo_lines.append(' '.join(map(str, yolo_line)))
-        
-        # Write label file
-        with open(label_path, 'w') as f:
-            f.write('\n'.join(yolo_lines))
-        
-        processed_count += 1
-        if processed_count % 100 == 0:
-            print(f"Processed {processed_count} images...")
+            processed_count += 1
+            if processed_count % 100 == 0:
+                print(f"Processed {processed_count} images...")
     
     print(f"Completed processing {processed_count} images for {split} split")
 
@@ -141,6 +171,7 @@ def main():
     parser.add_argument('--images-dir', required=True, help='Directory containing images')
     parser.add_argument('--output-dir', default='.', help='Output directory for YOLO dataset')
     parser.add_argument('--split', default='train', choices=['train', 'val', 'test'], help='Dataset split')
+    parser.add_argument('--workers', type=int, default=None, help='Worker processes (default: CPU count, 1 = sequential)')
     
     args = parser.parse_args()
     
@@ -152,7 +183,8 @@ def main():
         args.coco_annotations,
         args.images_dir,
         args.output_dir,
-        args.split
+        args.split,
+        args.workers
     )
     
     print(f"Dataset conversion completed for {args.split} split!")
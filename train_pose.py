@@ -5,17 +5,62 @@ Train YOLOv8 pose model on cattle pose estimation dataset
 
 import os
 import argparse
-from ultralytics import YOLO
-import torch
+from pathlib import Path
+from typing import TYPE_CHECKING, Optional, Union
+
+# torch and ultralytics are imported inside the functions that use them, so
+# --help and argument errors don't pay for loading them (or CUDA init).
+if TYPE_CHECKING:
+    from ultralytics import YOLO
+
+def resolve_cache_mode(data_yaml: str, imgsz: int, cache: str = "ram"):
+    """
+    Pick the dataset cache mode, downgrading 'ram' to 'disk' if the decoded
+    training images (at most imgsz x imgsz x 3 bytes each) would not fit in
+    available memory with a 20% margin. 'off' disables caching.
+    """
+    if cache == "off":
+        return False
+    if cache != "ram":
+        return cache
+    
+    import psutil
+    from ultralytics.data.utils import IMG_FORMATS, check_det_dataset
+    
+    train = check_det_dataset(data_yaml, autodownload=False)['train']
+    train_dirs = [Path(p) for p in (train if isinstance(train, (list, tuple)) else [train])]
+    if not all(d.is_dir() for d in train_dirs):
+        return cache  # image list files: leave it to Ultralytics' own RAM check
+    num_images = sum(
+        1 for train_dir in train_dirs for f in train_dir.rglob('*') if f.suffix[1:].lower() in IMG_FORMATS
+    )
+    dataset_bytes = num_images * imgsz * imgsz * 3
+    available = psutil.virtual_memory().available
+    if available < dataset_bytes * 1.2:
+        print(f"Dataset needs ~{dataset_bytes / 2**30:.1f}GB to cache in RAM but only "
+              f"{available / 2**30:.1f}GB is available; caching to disk instead")
+        return "disk"
+    return cache
 
 def train_cattle_pose_model(
     data_yaml: str = "datasets/cow_pose/cattle_pose.yaml",
     epochs: int = 100,
     imgsz: int = 640,
-    batch_size: int = 16,
+    batch_size: int = -1,
     device: str = "auto",
     project: str = "runs/pose",
-    name: str = "cattle_pose_train"
+    name: str = "cattle_pose_train",
+    amp: bool = True,
+    workers: int = min(16, os.cpu_count() or 8),
+    cache: str = "ram",
+    nbs: int = 64,
+    patience: int = 20,
+    rect: bool = False,
+    plots: bool = False,
+    optimizer: str = "AdamW",
+    lr0: float = 1e-3,
+    cos_lr: bool = True,
+    cudnn_benchmark: bool = True
 ):
     """
     Train YOLOv8 pose model on cattle pose estimation dataset
@@ -24,57 +69,177 @@ def train_cattle_pose_model(
         data_yaml: Path to dataset configuration YAML file
         epochs: Number of training epochs
         imgsz: Input image size
-        batch_size: Batch size for training
+        batch_size: Batch size for training (-1 = AutoBatch, largest batch fitting ~60% of GPU memory)
         device: Device to use for training ('auto', 'cpu', 'cuda', etc.)
         project: Project directory name
         name: Experiment name
+        amp: Automatic mixed precision (FP16 autocast with loss scaling, FP32
+            master weights); needs a Volta-or-newer GPU for Tensor Core speedups
+        workers: Dataloader worker processes (Ultralytics caps this at the
+            CPU count and the batch size)
+        cache: Decode images once and reuse them every epoch: 'ram', 'disk'
+            (.npy next to each image) or 'off'; 'ram' falls back to 'disk'
+            when the dataset won't fit in memory
+        nbs: Nominal batch size; gradients are accumulated over
+            max(round(nbs / batch), 1) batches before each optimizer step, so
+            the effective batch is batch * accumulate even when memory caps batch
+        patience: Stop early after this many epochs without validation
+            fitness improving (0 disables early stopping)
+        rect: Rectangular, aspect-ratio-sorted batches with less letterbox
+            padding; Ultralytics then disables mosaic/mixup and shuffling for
+            the whole run, so it trades accuracy for speed
+        plots: Render label/batch/metric plots (matplotlib) during training
+        optimizer: Optimizer name ('AdamW', 'SGD', ... or 'auto' to let
+            Ultralytics pick by iteration count)
+        lr0: Initial learning rate (ignored with optimizer='auto'); ~1e-3 for
+            Adam-family optimizers, ~1e-2 for SGD
+        cos_lr: Cosine learning rate decay instead of linear
+        cudnn_benchmark: Let cuDNN time and cache the fastest conv algorithm
+            per input shape; needs fixed shapes, so it is only applied with an
+            explicit batch size (AutoBatch refuses to run with it) and
+            rect=False, and gives up bitwise-deterministic training
+    
+    Returns:
+        (results, save_dir): the training metrics and the run directory
+        Ultralytics actually wrote to (it auto-increments taken names)
     """
     
     print("Starting cattle pose model training...")
     print(f"Dataset config: {data_yaml}")
-    print(f"Epochs: {epochs}")
+    print(f"Epochs: {epochs} (early stopping patience: {patience})")
     print(f"Image size: {imgsz}")
     print(f"Batch size: {batch_size}")
     print(f"Device: {device}")
+    print(f"AMP: {amp}")
+    print(f"Workers: {workers}")
+    print(f"Rectangular batches: {rect}")
+    print(f"Nominal batch size: {nbs}")
+    print(f"Optimizer: {optimizer} (lr0={lr0}, cosine LR: {cos_lr})")
     
     # Check if dataset exists
     if not os.path.exists(data_yaml):
         raise FileNotFoundError(f"Dataset configuration file not found: {data_yaml}")
     
+    import torch
+    from ultralytics import YOLO
+    
     # Check if CUDA is available
     if device == "auto":
-        device = "cuda" if torch.cuda.is_available() else "cpu"
+        # CUDA_VISIBLE_DEVICES="" (or -1) hides every GPU; answer from the
+        # environment instead of paying for a CUDA driver probe in CPU-only CI
+        if os.environ.get("CUDA_VISIBLE_DEVICES", "unset").strip() in ("", "-1"):
+            device = "cpu"
+        else:
+            device = "cuda" if torch.cuda.is_available() else "cpu"
         print(f"Auto-detected device: {device}")
     
-    # Load pre-trained YOLOv8 pose model
-    print("Loading YOLOv8 pose model...")
-    model = YOLO("yolov8n-pose.pt")  # You can also use yolov8s-pose.pt, yolov8m-pose.pt, etc.
+    benchmark = False
+    if device != "cpu" and torch.cuda.is_available():
+        # TF32 tensor-core matmuls/convs for the FP32 parts AMP leaves (Ampere+)
+        torch.backends.cuda.matmul.allow_tf32 = True
+        torch.backends.cudnn.allow_tf32 = True
+        torch.set_float32_matmul_precision("high")
+        benchmark = cudnn_benchmark and batch_size != -1 and not rect
+        torch.backends.cudnn.benchmark = benchmark
+        print(f"cuDNN benchmark: {benchmark}")
     
-    # Train the model
-    print("Starting training...")
-    results = model.train(
-        data=data_yaml,
-        epochs=epochs,
-        imgsz=imgsz,
-        batch=batch_size,
-        device=device,
-        project=project,
-        name=name,
-        save=True,
-        save_period=10,  # Save checkpoint every 10 epochs
-        val=True,
-        plots=True,
-        verbose=True
-    )
+    cache = resolve_cache_mode(data_yaml, imgsz, cache)
+    print(f"Cache: {cache}")
+    
+    # Train the model, halving the batch and starting over if the GPU runs out of memory
+    batch = batch_size
+    run_project, run_name, retrying = project, name, False
+    while True:
+        # Load pre-trained YOLOv8 pose model (fresh on retry, so no partial updates carry over)
+        print("Loading YOLOv8 pose model...")
+        model = YOLO("yolov8n-pose.pt")  # You can also use yolov8s-pose.pt, yolov8m-pose.pt, etc.
+        
+        print("Starting training...")
+        try:
+            results = model.train(
+                data=data_yaml,
+                epochs=epochs,
+                imgsz=imgsz,
+                batch=batch,
+                device=device,
+                workers=workers,
+                cache=cache,
+                nbs=nbs,
+                patience=patience,
+                rect=rect,
+                optimizer=optimizer,
+                lr0=lr0,
+                cos_lr=cos_lr,
+                deterministic=not benchmark,  # deterministic cuDNN would void the benchmark
+                project=run_project,
+                name=run_name,
+                exist_ok=retrying,  # reuse the run directory of the failed attempt
+                amp=amp,
+                save=True,
+                save_period=10,  # Save checkpoint every 10 epochs
+                val=True,
+                plots=plots,
+                verbose=True
+            )
+            break
+        except torch.cuda.OutOfMemoryError:
+            # With AutoBatch the trainer holds the batch size it actually picked
+            tried = model.trainer.batch_size if batch == -1 and model.trainer else batch
+            if tried <= 1:
+                raise
+            batch = max(1, tried // 2)
+            # Ultralytics may have auto-incremented the run name (runs/pose/x2),
+            # so point the retry at the directory the failed attempt really used
+            save_dir = getattr(model.trainer, "save_dir", None)
+            if save_dir is not None:
+                save_dir = Path(save_dir)
+                run_project, run_name, retrying = str(save_dir.parent), save_dir.name, True
+            print(f"CUDA out of memory at batch {tried}; retrying with batch {batch}")
+            del model
+            torch.cuda.empty_cache()
     
     print("Training completed!")
-    print(f"Results saved to: {os.path.join(project, name)}")
-    print(f"Best weights saved to: {os.path.join(project, name, 'weights', 'best.pt')}")
-    print(f"Last weights saved to: {os.path.join(project, name, 'weights', 'last.pt')}")
+    save_dir = Path(model.trainer.save_dir)
+    weights_dir = save_dir / 'weights'
+    print(f"Results saved to: {save_dir}")
+    print(f"Best weights saved to: {weights_dir / 'best.pt'}")
+    print(f"Last weights saved to: {weights_dir / 'last.pt'}")
     
-    return results
+    return results, save_dir
 
-def validate_model(model_path: str, data_yaml: str, imgsz: int = 640):
+def compile_for_validation(model: "YOLO", imgsz: int = 640) -> bool:
+    """
+    Compile the model's forward pass with torch.compile (CUDA graphs via
+    mode='reduce-overhead') and run one warmup pass so compilation happens
+    before validation starts. Returns False if compilation isn't available.
+    """
+    import torch
+    
+    if not hasattr(torch, "compile") or not torch.cuda.is_available():
+        print("torch.compile needs PyTorch 2.x and a CUDA GPU; validating eagerly")
+        return False
+    
+    net = model.model
+    # val() hands the module to AutoBackend, which fuses it and keeps whatever
+    # fuse() returns; fusing first and compiling the bound forward (rather than
+    # wrapping the module) keeps the compiled graph in use.
+    net.fuse(verbose=False)
+    net.eval()
+    net.forward = torch.compile(net.forward, mode="reduce-overhead", fullgraph=False)
+    net.to("cuda")
+    with torch.inference_mode():
+        net(torch.zeros(1, 3, imgsz, imgsz, device="cuda"))
+    return True
+
+def validate_model(
+    model_path: Union[str, Path],
+    data_yaml: str,
+    imgsz: int = 640,
+    compile_model: bool = False,
+    plots: bool = False,
+    save_json: bool = False,
+    save_hybrid: bool = False
+):
     """
     Validate the trained model
     
@@ -82,68 +247,196 @@ def validate_model(model_path: str, data_yaml: str, imgsz: int = 640):
         model_path: Path to trained model weights
         data_yaml: Path to dataset configuration YAML file
         imgsz: Input image size for validation
+        compile_model: Compile the model with torch.compile before validating;
+            compilation takes a minute or more, so it pays off on large val sets
+        plots: Render PR/F1 curves, confusion matrix and sample batches
+        save_json: Write predictions to a COCO-format JSON file
+        save_hybrid: Save labels merged with predictions (for relabeling;
+            this also alters the reported metrics)
     """
     print(f"Validating model: {model_path}")
     
+    from ultralytics import YOLO
+    
     # Load trained model
     model = YOLO(model_path)
+    if compile_model:
+        compile_for_validation(model, imgsz)
     
     # Run validation
     results = model.val(
         data=data_yaml,
         imgsz=imgsz,
-        save_json=True,
-        save_hybrid=True,
-        plots=True
+        save_json=save_json,
+        save_hybrid=save_hybrid,
+        plots=plots
     )
     
     print("Validation completed!")
     return results
 
+# Formats this Ultralytics version can post-training quantize to INT8
+# (TensorRT engines are FP16/FP32 only)
+INT8_EXPORT_FORMATS = ('openvino', 'tflite')
+# Formats that are only converted to FP16 when exported on a GPU
+GPU_FP16_EXPORT_FORMATS = ('onnx', 'engine')
+
+def export_model(model_path: Union[str, Path], fmt: str, imgsz: int = 640, quantize: str = "fp16", data_yaml: Optional[str] = None):
+    """
+    Export trained weights for deployment
+    
+    Args:
+        model_path: Path to trained model weights
+        fmt: Export format ('torchscript', 'onnx', 'engine' for TensorRT,
+            'openvino' or 'tflite')
+        imgsz: Input image size baked into the exported model
+        quantize: 'fp16', or 'int8' for post-training quantization
+            (openvino/tflite only), calibrated on data_yaml's val split
+        data_yaml: Path to dataset configuration YAML file (INT8 calibration)
+    
+    With quantize='fp16', ONNX and TensorRT are exported on GPU 0 so they come
+    out FP16 (ONNX falls back to FP32 without a GPU; TensorRT needs one),
+    OpenVINO and TFLite store FP16 weights, and TorchScript always stays
+    FP32 since Ultralytics never halves it. INT8 only pays off on hardware with
+    native int8 kernels (OpenVINO on VNNI/AMX CPUs, XNNPACK/Edge TPU for
+    TFLite); elsewhere it can be slower than FP32. The exported file is
+    written next to the weights.
+    """
+    int8 = quantize == "int8"
+    if int8 and fmt not in INT8_EXPORT_FORMATS:
+        raise ValueError(f"INT8 export supports {', '.join(INT8_EXPORT_FORMATS)}, not {fmt}")
+    if int8 and not data_yaml:
+        raise ValueError("INT8 export needs a dataset YAML for calibration")
+    
+    import torch
+    from ultralytics import YOLO
+    
+    half = not int8 and fmt != 'torchscript'
+    # Ultralytics exports on the CPU unless told otherwise, and silently
+    # drops half for ONNX there
+    device = 0 if fmt in GPU_FP16_EXPORT_FORMATS and torch.cuda.is_available() else 'cpu'
+    if half and fmt == 'onnx' and device == 'cpu':
+        print("No CUDA GPU available; ONNX will be exported in FP32")
+        half = False
+    precision = 'int8' if int8 else 'fp16' if half else 'fp32'
+    print(f"Exporting model: {model_path} ({fmt}, {precision})")
+    
+    exported = YOLO(model_path).export(
+        format=fmt,
+        half=half,
+        int8=int8,
+        data=data_yaml,
+        imgsz=imgsz,
+        device=device,
+        simplify=True
+    )
+    
+    print(f"Export completed: {exported}")
+    return exported
+
 def main():
     parser = argparse.ArgumentParser(description='Train YOLOv8 pose model on cattle pose dataset')
     parser.add_argument('--data', default='datasets/cow_pose/cattle_pose.yaml', 
                        help='Path to dataset YAML file')
     parser.add_argument('--epochs', type=int, default=100, 
                        help='Number of training epochs')
+    parser.add_argument('--patience', type=int, default=20, 
+                       help='Early stopping after this many epochs without improvement (0 = off)')
     parser.add_argument('--imgsz', type=int, default=640, 
                        help='Input image size')
-    parser.add_argument('--batch', type=int, default=16, 
-                       help='Batch size')
+    parser.add_argument('--batch', type=int, default=-1, 
+                       help='Batch size (-1 = AutoBatch)')
     parser.add_argument('--device', default='auto', 
                        help='Device to use (auto, cpu, cuda, etc.)')
     parser.add_argument('--project', default='runs/pose', 
                        help='Project directory')
     parser.add_argument('--name', default='cattle_pose_train', 
                        help='Experiment name')
+    parser.add_argument('--workers', type=int, default=min(16, os.cpu_count() or 8), 
+                       help='Dataloader worker processes')
+    parser.add_argument('--optimizer', default='AdamW', 
+                       choices=['SGD', 'Adam', 'Adamax', 'AdamW', 'NAdam', 'RAdam', 'RMSProp', 'auto'], 
+                       help='Optimizer (auto = Ultralytics picks by iteration count)')
+    parser.add_argument('--lr0', type=float, default=1e-3, 
+                       help='Initial learning rate (~1e-3 for Adam-family, ~1e-2 for SGD)')
+    parser.add_argument('--cos-lr', action=argparse.BooleanOptionalAction, default=True, 
+                       help='Cosine learning rate schedule')
+    parser.add_argument('--cudnn-benchmark', action=argparse.BooleanOptionalAction, default=True, 
+                       help='cuDNN autotuning for fixed input shapes (applies with an explicit --batch and no --rect; '
+                            'training is then not bitwise deterministic)')
+    parser.add_argument('--nbs', type=int, default=64, 
+                       help='Nominal batch size; effective batch = batch * max(round(nbs / batch), 1) via gradient accumulation')
+    parser.add_argument('--rect', action='store_true', 
+                       help='Rectangular batches (less padding, but disables mosaic/mixup and shuffling)')
+    parser.add_argument('--cache', default='ram', choices=['ram', 'disk', 'off'], 
+                       help='Dataset image cache (ram falls back to disk if memory is short)')
+    parser.add_argument('--amp', action=argparse.BooleanOptionalAction, default=True,
+                       help='Mixed precision training (--no-amp to force FP32)')
     parser.add_argument('--validate', action='store_true', 
                        help='Run validation after training')
+    parser.add_argument('--export', choices=['torchscript', 'onnx', 'engine', 'openvino', 'tflite'], 
+                       help='Export best weights after training (engine = TensorRT, needs a GPU)')
+    parser.add_argument('--quantize', default='fp16', choices=['fp16', 'int8'], 
+                       help='Export precision (torchscript is always fp32; onnx/engine fp16 needs a GPU); int8 (openvino/tflite only) calibrates on the val split '
+                            'and only helps on hardware with native int8 kernels')
+    parser.add_argument('--plots', action=argparse.BooleanOptionalAction, default=False, 
+                       help='Render training/validation plots (matplotlib, slow per epoch)')
+    parser.add_argument('--save-json', action='store_true', 
+                       help='Save validation predictions as COCO JSON')
+    parser.add_argument('--save-hybrid', action='store_true', 
+                       help='Save validation labels merged with predictions')
+    parser.add_argument('--compile', action='store_true', 
+                       help='Use torch.compile for validation (PyTorch 2.x, CUDA only)')
     
     args = parser.parse_args()
+    if args.quantize == 'int8' and args.export not in INT8_EXPORT_FORMATS:
+        parser.error(f"--quantize int8 needs --export {' or '.join(INT8_EXPORT_FORMATS)}")
     
     try:
         # Train the model
-        results = train_cattle_pose_model(
+        results, save_dir = train_cattle_pose_model(
             data_yaml=args.data,
             epochs=args.epochs,
             imgsz=args.imgsz,
             batch_size=args.batch,
             device=args.device,
             project=args.project,
-            name=args.name
+            name=args.name,
+            amp=args.amp,
+            workers=args.workers,
+            cache=args.cache,
+            nbs=args.nbs,
+            patience=args.patience,
+            rect=args.rect,
+            plots=args.plots,
+            optimizer=args.optimizer,
+            lr0=args.lr0,
+            cos_lr=args.cos_lr,
+            cudnn_benchmark=args.cudnn_benchmark
         )
         
+        best_model_path = save_dir / 'weights' / 'best.pt'
+        
         # Run validation if requested
         if args.validate:
-            best_model_path = os.path.join(args.project, args.name, 'weights', 'best.pt')
-            if os.path.exists(best_model_path):
-                validate_model(best_model_path, args.data, args.imgsz)
+            if best_model_path.exists():
+                validate_model(
+                    best_model_path, args.data, args.imgsz, args.compile,
+                    args.plots, args.save_json, args.save_hybrid
+                )
+            else:
+                print(f"Warning: Best model not found at {best_model_path}")
+        
+        # Export for deployment if requested
+        if args.export:
+            if best_model_path.exists():
+                export_model(best_model_path, args.export, args.imgsz, args.quantize, args.data)
             else:
                 print(f"Warning: Best model not found at {best_model_path}")
         
         print("\nTraining pipeline completed successfully!")
         print(f"To use the trained model in your FastAPI backend:")
-        print(f"1. Copy the best weights: {os.path.join(args.project, args.name, 'weights', 'best.pt')}")
+        print(f"1. Copy the best weights: {best_model_path}")
         print(f"2. Update the model path in backend/pose_utils.py")
         
     except Exception as e: